@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# codify on a multi-MB transcript: the old whole-text regex vs FenceParser
+#
+#   python3 benchmarks/bench_codify.py [megabytes]
+
+import json
+import os
+import random
+import re
+import string
+import sys
+import tempfile
+import time
+
+HOME = tempfile.mkdtemp(prefix="hey_bench_")
+os.environ["HOME"] = HOME
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import hey  # noqa: E402
+
+
+def transcript(megabytes: float):
+    random.seed(1)
+    parts = []
+    size = 0
+    while size < megabytes * 1024 * 1024:
+        text = " ".join(
+            "".join(random.choices(string.ascii_lowercase, k=random.randint(2, 9)))
+            for _ in range(random.randint(30, 200))
+        )
+        code = "\n".join(
+            f"    value_{i} = compute({random.randint(0, 999)})" for i in range(20)
+        )
+        part = f"\n### Assistant\n{text}\n\n```python\n{code}\n```\n"
+        parts.append(part)
+        size += len(part)
+    return "".join(parts)
+
+
+def regex_annotation(markdown_text: str):
+    # the pre FenceParser implementation, kept here as the baseline
+    def replacer(match: re.Match[str]) -> str:
+        s = match.group(0)
+        try:
+            language_line = match.group(1).split("\n", 1)[0]
+            code_block = match.group(1).split("\n", 1)[1]
+        except IndexError:
+            return s
+        return s + annotate(language_line, code_block)
+
+    return re.sub(r"```(.*?)```", replacer, markdown_text, flags=re.DOTALL)
+
+
+def annotate(info: str, code: str):
+    return "\n\n [copy:](x)\n\n[snippet:](y)"
+
+
+def timed(fn):
+    start = time.perf_counter()
+    out = fn()
+    return time.perf_counter() - start, out
+
+
+def main():
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 4
+    text = transcript(megabytes)
+
+    def parser_whole():
+        p = hey.FenceParser(annotate)
+        return p.feed(text) + p.close()
+
+    def parser_streamed():
+        p = hey.FenceParser(annotate)
+        out = [p.feed(text[i : i + 64]) for i in range(0, len(text), 64)]
+        return "".join(out) + p.close()
+
+    regex_s, regex_out = timed(lambda: regex_annotation(text))
+    whole_s, whole_out = timed(parser_whole)
+    streamed_s, streamed_out = timed(parser_streamed)
+    # the real codify path, snippet store included (first run writes, second reuses)
+    cold_s, _ = timed(lambda: hey.util.language_annotation(text))
+    warm_s, _ = timed(lambda: hey.util.language_annotation(text))
+
+    print(
+        json.dumps(
+            {
+                "bytes": len(text),
+                "blocks": text.count("```python"),
+                "regex_s": regex_s,
+                "parser_s": whole_s,
+                "parser_streamed_64b_s": streamed_s,
+                "same_output": regex_out == whole_out == streamed_out,
+                "codify_cold_s": cold_s,
+                "codify_warm_s": warm_s,
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# size and load-time comparison: legacy inline json contexts vs header + chunk log
+#
+#   python3 benchmarks/bench_context_format.py [convos] [messages]
+
+import json
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+HOME = tempfile.mkdtemp(prefix="hey_bench_")
+os.environ["HOME"] = HOME
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import hey  # noqa: E402
+
+
+def words(n: int):
+    return " ".join(
+        "".join(random.choices(string.ascii_lowercase, k=random.randint(2, 9)))
+        for _ in range(n)
+    )
+
+
+def messages(count: int):
+    out = []
+    for i in range(count):
+        role = "user" if i % 2 == 0 else "assistant"
+        body = words(random.randint(20, 400))
+        if role == "assistant" and i % 4 == 1:
+            body += "\n```python\n" + "print('hello world')\n" * 20 + "```\n"
+        out.append({"role": role, "content": body})
+    return out
+
+
+def dir_size(path: str, suffix: str = ""):
+    return sum(
+        os.path.getsize(os.path.join(path, f))
+        for f in os.listdir(path)
+        if f.startswith(".hey_context.") and f.endswith(suffix)
+    )
+
+
+def timed(fn):
+    # every phase starts cold like a new cli process, the writes above and the
+    # phases before it must not leave parsed files behind
+    hey.FileCache.entries.clear()
+    hey.BlobStore.cache.clear()
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def main():
+    convos = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    random.seed(1)
+    legacy_dir = os.path.join(HOME, "legacy")
+    chunked_dir = os.path.join(HOME, "chunked")
+    os.makedirs(legacy_dir)
+    os.makedirs(chunked_dir)
+
+    ids = [f"c{i}" for i in range(convos)]
+    for convo in ids:
+        msgs = messages(count)
+        ctx = hey.Context.New(prompts_dir=chunked_dir, convo=convo)
+        ctx.obj["smart_title"] = words(5)
+        ctx.messages = msgs
+        legacy = {
+            k: v for k, v in ctx.obj.items() if k not in ("chunks", "message_count")
+        }
+        with open(hey.util.ctx_path(legacy_dir, convo), "w") as f:
+            f.write(json.dumps({**legacy, "messages": msgs}))
+
+    def load_legacy_meta():
+        for convo in ids:
+            with open(hey.util.ctx_path(legacy_dir, convo)) as f:
+                json.load(f)["smart_title"]
+
+    def load_chunked_meta():
+        for convo in ids:
+            ctx = hey.Context.New(prompts_dir=chunked_dir, convo=convo)
+            ctx.open()
+            ctx.smart_title
+
+    def load_legacy_full():
+        for convo in ids:
+            ctx = hey.Context.New(prompts_dir=legacy_dir, convo=convo)
+            ctx.open()
+            ctx.messages
+
+    def load_chunked_full():
+        for convo in ids:
+            ctx = hey.Context.New(prompts_dir=chunked_dir, convo=convo)
+            ctx.open()
+            ctx.messages
+
+    results = {
+        "convos": convos,
+        "messages": count,
+        "codec": "zstd" if hey.zstandard is not None else "zlib",
+        "legacy_bytes": dir_size(legacy_dir),
+        "chunked_bytes": dir_size(chunked_dir),
+        "chunked_header_bytes": dir_size(chunked_dir, ".json"),
+        "legacy_meta_s": timed(load_legacy_meta),
+        "chunked_meta_s": timed(load_chunked_meta),
+        "legacy_full_s": timed(load_legacy_full),
+        "chunked_full_s": timed(load_chunked_full),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# synthetic conversation corpora in the current on-disk format
+#
+#   python3 benchmarks/corpus.py <prompts_dir> [convos] [messages]
+
+import os
+import random
+import string
+import sys
+import tempfile
+from datetime import datetime
+from typing import Any, List
+
+WORDS = [
+    "".join(
+        random.Random(i).choices(
+            string.ascii_lowercase, k=random.Random(i).randint(2, 9)
+        )
+    )
+    for i in range(2000)
+]
+
+
+def sentence(rng: random.Random, n: int):
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+def message(rng: random.Random, i: int):
+    if i % 2 == 0:
+        return {"role": "user", "content": sentence(rng, rng.randint(5, 60))}
+    body = sentence(rng, rng.randint(40, 300))
+    if rng.random() < 0.5:
+        lines = "\n".join(
+            f"    x_{j} = {sentence(rng, 3)!r}" for j in range(rng.randint(3, 30))
+        )
+        body += f"\n\n```python\ndef f():\n{lines}\n```\n\n" + sentence(rng, 20)
+    return {"role": "assistant", "content": body}
+
+
+def build(
+    hey: Any,
+    prompts_dir: str,
+    convos: int,
+    messages: int,
+    untitled: float = 0.0,
+    seed: int = 1,
+):
+    rng = random.Random(seed)
+    os.makedirs(prompts_dir, exist_ok=True)
+    now = datetime.now().isoformat()
+    ids: List[str] = []
+    for c in range(convos):
+        convo = f"bench{c:05d}"
+        ids.append(convo)
+        ctx = hey.Context.New(prompts_dir=prompts_dir, convo=convo)
+        msgs = [message(rng, i) for i in range(messages)]
+        if rng.random() >= untitled:
+            title = sentence(rng, 4)
+            slug = hey.util.slugify(title) + f"_{c}"
+            md_file = os.path.join(prompts_dir, slug + ".md")
+            ctx.obj.update(
+                {
+                    "smart_title": title,
+                    "smart_title_slug": slug,
+                    "md_file": md_file,
+                    "start_date": now,
+                    "end_date": now,
+                }
+            )
+            with open(md_file, "w") as f:
+                f.write(
+                    hey.util.title_block(title) + hey.util.date_block(datetime.now())
+                )
+                f.write("".join(hey.util.msg_block(m) for m in msgs))
+        ctx.messages = msgs
+    config = hey.Config(prompts_dir=prompts_dir)
+    config.obj["convo"] = ids[0] if ids else hey.DEFAULT_CONVO
+    config.obj["context_filename"] = hey.util.ctx_path(prompts_dir, config.obj["convo"])
+    config.obj["editor"] = "true"
+    config.save()
+    return ids
+
+
+if __name__ == "__main__":
+    # importing hey installs a prompts dir under HOME, keep that out of the real one
+    os.environ["HOME"] = tempfile.mkdtemp(prefix="hey_bench_")
+    os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+    import hey
+
+    target = sys.argv[1]
+    n_convos = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    n_messages = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    build(hey, target, n_convos, n_messages)
+    print(f"{n_convos} convos x {n_messages} messages in {target}")
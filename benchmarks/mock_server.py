@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# stdlib mock of the openai chat completions api for benchmarks
+#
+#   python3 benchmarks/mock_server.py --port 8765 --latency 50 --token_delay 5 \
+#       --error_every 10
+#   OPENAI_BASE_URL=http://127.0.0.1:8765/v1 python3 hey.py ...
+
+import argparse
+import json
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import deque
+from typing import Any, Deque, Dict
+
+ANSWER = (
+    "Sure, here is an example:\n\n```python\n"
+    "def fizzbuzz(n):\n"
+    "    for i in range(1, n + 1):\n"
+    "        print('Fizz' * (i % 3 == 0) + 'Buzz' * (i % 5 == 0) or i)\n"
+    "```\n\nLet me know if you need anything else."
+)
+
+
+class MockState:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        token_delay: float = 0.0,
+        error_every: int = 0,
+        answer: str = ANSWER,
+        chunk_size: int = 4,
+        requests_limit: int = 500,
+        gzip: bool = False,
+    ):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.error_every = error_every
+        self.answer = answer
+        self.chunk_size = chunk_size
+        self.requests_limit = requests_limit
+        self.gzip = gzip
+        self.count = 0
+        # request times within the last second, the rate limit window
+        self.recent: Deque[float] = deque()
+        self.lock = threading.Lock()
+
+    def next(self):
+        with self.lock:
+            self.count += 1
+            now = time.monotonic()
+            self.recent.append(now)
+            while self.recent[0] < now - 1:
+                self.recent.popleft()
+            return self.count
+
+    def used(self):
+        with self.lock:
+            return len(self.recent)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, keep-alive clients would wait
+    # on delayed acks
+    disable_nagle_algorithm = True
+    state: MockState = MockState()
+
+    def log_message(self, format: str, *args: Any):
+        pass
+
+    def ratelimit_headers(self):
+        remaining = max(0, self.state.requests_limit - self.state.used())
+        self.send_header("x-ratelimit-limit-requests", str(self.state.requests_limit))
+        self.send_header("x-ratelimit-remaining-requests", str(remaining))
+        self.send_header("x-ratelimit-reset-requests", "1s")
+        self.send_header("x-ratelimit-limit-tokens", "200000")
+        self.send_header("x-ratelimit-remaining-tokens", "199000")
+        self.send_header("x-ratelimit-reset-tokens", "300ms")
+
+    def gzipped(self):
+        return self.state.gzip and "gzip" in self.headers.get("Accept-Encoding", "")
+
+    def send_json(self, status: int, obj: Dict[str, Any], ratelimit: bool = False):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if self.gzipped():
+            body = zlib.compress(body, wbits=16 + zlib.MAX_WBITS)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        if ratelimit:
+            self.ratelimit_headers()
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith(("/engines", "/models")):
+            models = ["gpt-3.5-turbo", "gpt-4", "gpt-4o", "gpt-4o-mini"]
+            return self.send_json(200, {"data": [{"id": m} for m in models]})
+        self.send_json(404, {"error": {"message": "not found"}})
+
+    def do_HEAD(self):
+        # the warm-up request hey sends while the editor is open
+        self.send_response(
+            200 if self.path.rstrip("/").endswith(("/engines", "/models")) else 404
+        )
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def chunk(self, data: bytes, gz: Any = None):
+        if gz and data:
+            # sync flush so every event can be decoded as soon as it arrives
+            data = gz.compress(data) + gz.flush(zlib.Z_SYNC_FLUSH)
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        req = json.loads(self.rfile.read(length) or b"{}")
+        n = self.state.next()
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        over = self.state.used() > self.state.requests_limit
+        if over or (self.state.error_every and n % self.state.error_every == 0):
+            return self.send_json(
+                429,
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                True,
+            )
+        answer = self.state.answer
+        prompt_tokens = (
+            sum(len(str(m.get("content", ""))) for m in req.get("messages", [])) // 4
+        )
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(answer) // 4,
+            "total_tokens": prompt_tokens + len(answer) // 4,
+        }
+        if not req.get("stream"):
+            return self.send_json(
+                200,
+                {
+                    "id": f"chatcmpl-{n}",
+                    "object": "chat.completion",
+                    "model": req.get("model"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": answer},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": usage,
+                },
+                True,
+            )
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        gz = None
+        if self.gzipped():
+            gz = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+            self.send_header("Content-Encoding", "gzip")
+        self.ratelimit_headers()
+        self.end_headers()
+        size = self.state.chunk_size
+        for i in range(0, len(answer), size):
+            event = {
+                "id": f"chatcmpl-{n}",
+                "object": "chat.completion.chunk",
+                "model": req.get("model"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": answer[i : i + size]},
+                        "finish_reason": None,
+                    }
+                ],
+            }
+            self.chunk(b"data: " + json.dumps(event).encode() + b"\n\n", gz)
+            if self.state.token_delay:
+                time.sleep(self.state.token_delay)
+        if req.get("stream_options", {}).get("include_usage"):
+            event = {"id": f"chatcmpl-{n}", "choices": [], "usage": usage}
+            self.chunk(b"data: " + json.dumps(event).encode() + b"\n\n", gz)
+        self.chunk(b"data: [DONE]\n\n", gz)
+        if gz:
+            self.chunk(gz.flush())
+        self.chunk(b"")
+
+
+class MockServer:
+    def __init__(self, state: MockState, port: int = 0):
+        handler = type("BoundHandler", (Handler,), {"state": state})
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.httpd.daemon_threads = True
+        self.state = state
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="mock openai chat completions server")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0, help="ms before responding")
+    parser.add_argument(
+        "--token_delay", type=float, default=0, help="ms between stream chunks"
+    )
+    parser.add_argument(
+        "--error_every", type=int, default=0, help="answer every nth request with 429"
+    )
+    parser.add_argument(
+        "--gzip", action="store_true", help="gzip bodies when the client accepts it"
+    )
+    parser.add_argument(
+        "--requests_limit",
+        type=int,
+        default=500,
+        help="requests per second before 429s",
+    )
+    args = parser.parse_args()
+    state = MockState(
+        args.latency / 1000,
+        args.token_delay / 1000,
+        args.error_every,
+        requests_limit=args.requests_limit,
+        gzip=args.gzip,
+    )
+    server = MockServer(state, args.port)
+    print(f"listening on {server.base_url}")
+    server.httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
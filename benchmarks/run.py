@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# end to end scenario benchmarks: runs the real hey.py cli against the mock server
+#
+#   python3 benchmarks/run.py --convos 100 --messages 20 --repeat 5 --out before.json
+#   python3 benchmarks/run.py ... --out after.json --compare before.json
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+HEY = os.path.join(ROOT, "hey.py")
+WORK = tempfile.mkdtemp(prefix="hey_bench_")
+# stands in for vim: a bit of think time, then :wq with a prompt
+EDITOR = os.path.join(WORK, "editor.sh")
+
+os.environ["HOME"] = WORK
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(__file__))
+
+import hey  # noqa: E402
+import corpus  # noqa: E402
+from mock_server import MockServer, MockState  # noqa: E402
+
+
+class Scenario:
+    def __init__(
+        self,
+        name: str,
+        args: List[str],
+        corpus: str = "main",
+        prepare: List[List[str]] = [],
+    ):
+        self.name = name
+        self.args = args
+        self.corpus = corpus
+        # untimed commands run on the copy before the measured one
+        self.prepare = prepare
+
+
+SCENARIOS = [
+    Scenario("startup", ["--get_model"]),
+    Scenario("convos", ["--convos"]),
+    Scenario("single_turn", ["--no_editor", "hello", "there"]),
+    Scenario("streamed_turn", ["--stream", "--no_editor", "hello", "there"]),
+    # editor_to_first_token is the span to watch here
+    Scenario("editor_turn", ["--stream"], prepare=[["--editor", EDITOR]]),
+    Scenario("show_codify", ["--codify", "--show", "0"]),
+    Scenario("recent", ["--recent"]),
+    Scenario("archive", ["--archive"]),
+    Scenario("tidy", ["--tidy"], corpus="untitled"),
+]
+
+
+def write_editor(think_ms: float):
+    with open(EDITOR, "w") as f:
+        f.write(
+            f'#!/bin/sh\nsleep {think_ms / 1000}\necho "hello from the editor" > "$1"\n'
+        )
+    os.chmod(EDITOR, 0o755)
+
+
+def run_once(home: str, base_url: str, args: List[str]):
+    trace = os.path.join(home, "trace.json")
+    env = {
+        **os.environ,
+        "HOME": home,
+        "OPENAI_BASE_URL": base_url,
+        "OPENAI_API_KEY": "sk-bench",
+        "EDITOR": "true",
+        "HEY_OUT": os.path.join(home, "hey_out.md"),
+        "HEY_TRACE": trace,
+    }
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, HEY, *args],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        stdin=subprocess.DEVNULL,
+    )
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise Exception(f"{args} failed: {proc.stderr.decode()[-2000:]}")
+    spans: Dict[str, float] = {}
+    if os.path.exists(trace):
+        with open(trace) as f:
+            spans = json.load(f).get("spans", {})
+    return elapsed * 1000, spans
+
+
+def summary(samples: List[float], spans: List[Dict[str, float]]):
+    ordered = sorted(samples)
+    names = sorted({name for run in spans for name in run})
+    return {
+        "runs": len(samples),
+        "min_ms": ordered[0],
+        "median_ms": statistics.median(ordered),
+        "p95_ms": ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+        # in-process phase breakdown from hey's own telemetry (HEY_TRACE)
+        "spans_median_ms": {
+            name: statistics.median(run.get(name, 0.0) for run in spans)
+            for name in names
+        },
+    }
+
+
+def git_rev():
+    try:
+        return subprocess.check_output(
+            ["git", "-C", ROOT, "rev-parse", "--short", "HEAD"], text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: Dict[str, Any], baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\n{'scenario':<16}{'before ms':>12}{'after ms':>12}{'change':>10}")
+    for name, result in current["scenarios"].items():
+        before = baseline["scenarios"].get(name)
+        if not before:
+            continue
+        b, a = before["median_ms"], result["median_ms"]
+        print(f"{name:<16}{b:>12.1f}{a:>12.1f}{(a - b) / b * 100:>9.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="hey.py scenario benchmarks")
+    parser.add_argument("--convos", type=int, default=100, help="10 to 10000")
+    parser.add_argument("--messages", type=int, default=20, help="1 to 1000")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0, help="mock server ms")
+    parser.add_argument(
+        "--token_delay", type=float, default=0, help="mock ms per chunk"
+    )
+    parser.add_argument(
+        "--think", type=float, default=300, help="ms spent in the fake editor"
+    )
+    parser.add_argument("--only", type=str, action="append", help="scenario name")
+    parser.add_argument("--out", type=str, help="write json results here")
+    parser.add_argument("--compare", type=str, help="baseline json to diff against")
+    args = parser.parse_args()
+
+    server = MockServer(MockState(args.latency / 1000, args.token_delay / 1000)).start()
+    write_editor(args.think)
+    templates = {
+        "main": os.path.join(WORK, "template_main"),
+        "untitled": os.path.join(WORK, "template_untitled"),
+    }
+    scenarios = [s for s in SCENARIOS if not args.only or s.name in args.only]
+    for name in {s.corpus for s in scenarios}:
+        untitled = 0.3 if name == "untitled" else 0.0
+        corpus.build(
+            hey,
+            os.path.join(templates[name], ".hey_py"),
+            args.convos,
+            args.messages,
+            untitled=untitled,
+        )
+
+    results: Dict[str, Any] = {
+        "meta": {
+            "commit": git_rev(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "convos": args.convos,
+            "messages": args.messages,
+            "repeat": args.repeat,
+            "latency_ms": args.latency,
+            "token_delay_ms": args.token_delay,
+            "think_ms": args.think,
+        },
+        "scenarios": {},
+    }
+    try:
+        for scenario in scenarios:
+            samples: List[float] = []
+            spans: List[Dict[str, float]] = []
+            for i in range(args.repeat):
+                # every run starts from the same copy, so archive/tidy have work to do
+                home = os.path.join(WORK, f"{scenario.name}_{i}")
+                shutil.copytree(templates[scenario.corpus], home)
+                for prepare in scenario.prepare:
+                    run_once(home, server.base_url, prepare)
+                elapsed, run_spans = run_once(home, server.base_url, scenario.args)
+                samples.append(elapsed)
+                spans.append(run_spans)
+                shutil.rmtree(home)
+            results["scenarios"][scenario.name] = summary(samples, spans)
+            print(
+                f"{scenario.name:<16}"
+                f"{results['scenarios'][scenario.name]['median_ms']:>10.1f} ms",
+                file=sys.stderr,
+            )
+    finally:
+        server.stop()
+        shutil.rmtree(WORK, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# http transports side by side: import cost, cold cli turns and throughput
+# against the mock server
+#
+#   python3 benchmarks/transport.py --requests 200 --answer_kb 64 --out transport.json
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+HEY = os.path.join(ROOT, "hey.py")
+WORK = tempfile.mkdtemp(prefix="hey_bench_")
+
+os.environ["HOME"] = WORK
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(__file__))
+
+import hey  # noqa: E402
+import corpus  # noqa: E402
+from mock_server import ANSWER, MockServer, MockState  # noqa: E402
+
+
+def median_ms(cmd: List[str], repeat: int, env: Dict[str, str] = {}):
+    samples: List[float] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            cmd,
+            env={**os.environ, **env},
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stdin=subprocess.DEVNULL,
+        )
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def imports(repeat: int):
+    python = [sys.executable, "-c"]
+    base = median_ms([*python, "pass"], repeat)
+    result = {
+        "python_ms": base,
+        "hey_ms": median_ms([*python, "import hey"], repeat, {"PYTHONPATH": ROOT}),
+    }
+    if hey.HAS_REQUESTS:
+        result["requests_ms"] = median_ms([*python, "import requests"], repeat)
+    return result
+
+
+def turns(base_url: str, transports: List[str], repeat: int):
+    # a whole `hey --no_editor` turn in a fresh process, import included
+    template = os.path.join(WORK, "template")
+    corpus.build(hey, os.path.join(template, ".hey_py"), 1, 2)
+    result: Dict[str, float] = {}
+    for transport in transports:
+        home = os.path.join(WORK, f"turn_{transport}")
+        shutil.copytree(template, home)
+        env = {"HOME": home, "OPENAI_BASE_URL": base_url, "EDITOR": "true"}
+        subprocess.run(
+            [sys.executable, HEY, "--transport", transport],
+            env={**os.environ, **env},
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        result[transport] = median_ms(
+            [sys.executable, HEY, "--no_editor", "hello"], repeat, env
+        )
+        shutil.rmtree(home)
+    return result
+
+
+def throughput(server: MockServer, transports: List[str], n: int, answer_kb: int):
+    messages = [{"role": "user", "content": "hello"}]
+    big = (ANSWER * (answer_kb * 1024 // len(ANSWER) + 1))[: answer_kb * 1024]
+    result: Dict[str, Any] = {}
+    for transport in transports:
+        hey.Fetch.transport = transport
+        fetch = hey.Fetch.New()
+        server.state.answer = ANSWER
+        start = time.perf_counter()
+        for _ in range(n):
+            _, error = fetch.prompt(messages, "gpt-4o")
+            if error:
+                raise error
+        small = time.perf_counter() - start
+
+        server.state.answer = big
+        received = 0
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for _ in range(max(1, n // 10)):
+                text, error = fetch.prompt(messages, "gpt-4o", stream=True, pipe=True)
+                if error:
+                    raise error
+                received += len(text or "")
+        streamed = time.perf_counter() - start
+        result[transport] = {
+            "requests_per_s": n / small,
+            "stream_mb_per_s": received / streamed / 1e6,
+        }
+        print(
+            f"{transport:<10}{n / small:>10.0f} "
+            f"req/s{received / streamed / 1e6:>10.2f} MB/s",
+            file=sys.stderr,
+        )
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="hey.py http transport comparison")
+    parser.add_argument(
+        "--requests", type=int, default=200, help="sequential prompts per transport"
+    )
+    parser.add_argument(
+        "--answer_kb", type=int, default=64, help="size of a streamed answer"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=9, help="process runs for import and turn timings"
+    )
+    parser.add_argument(
+        "--gzip", action="store_true", help="mock server gzips what it can"
+    )
+    parser.add_argument("--out", type=str, help="write json results here")
+    args = parser.parse_args()
+
+    hey.Telemetry.enabled = False
+    transports = [t for t in hey.TRANSPORTS if t != "requests" or hey.HAS_REQUESTS]
+    server = MockServer(MockState(gzip=args.gzip, chunk_size=64)).start()
+    hey.Fetch.prompt_url = server.base_url + "/chat/completions"
+    hey.Fetch.engine_url = server.base_url + "/engines"
+    results: Dict[str, Any] = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "requests": args.requests,
+            "answer_kb": args.answer_kb,
+            "gzip": args.gzip,
+        }
+    }
+    try:
+        results["import"] = imports(args.repeat)
+        results["turn_ms"] = turns(server.base_url, transports, args.repeat)
+        results["throughput"] = throughput(
+            server, transports, args.requests, args.answer_kb
+        )
+    finally:
+        server.stop()
+        shutil.rmtree(WORK, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
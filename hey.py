@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
 
+import time
+
+# taken before the other imports so telemetry can report the import cost
+STARTED = time.perf_counter()
+
 from datetime import datetime, timedelta
 import os
 import difflib
@@ -9,23 +14,111 @@ import subprocess
 import json
 import tempfile
 from typing import Tuple, Any, Callable, Dict, List, Optional, TypedDict
-import requests
 import argparse
 import base64
+import codecs
+import concurrent.futures
+import atexit
+import contextlib
+import functools
 import hashlib
+import importlib.util
+import io
+import signal
+import struct
 import sys
-from typing import List, Union
+import threading
+import urllib.parse
+import zlib
+from typing import Iterable, List, NotRequired, Union
+
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks (windows), writes are still atomic renames
+    fcntl = None
 
 
 global PROMPTS_DIR
 PROMPTS_DIR: str = os.path.join(os.environ.get("HOME"), ".hey_py")  # type: ignore
 OPENAIKEY: str = os.environ.get("OPENAI_API_KEY")  # type: ignore
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1")
+OPENAI_BASE_URL = OPENAI_BASE_URL.rstrip("/")
 CFG_FILENAME = ".hey_config.json"
+ACTIVE_FILENAME = ".hey_active"
+INDEX_FILENAME = ".hey_convos.json"
 DEFAULT_CONVO = "main"
 DEFAULT_CTX_FILENAME = ".hey_context.main.json"
 EDITOR = os.environ.get("EDITOR", "nvim")
 DEFAULT_DETAIL = "low"
 MAX_TOKENS = 2048
+SNIPPETS_MAX = 2000
+METRICS_FILENAME = ".hey_metrics.jsonl"
+# HEY_OUT_SYNC: flush the HEY_OUT file at exit, on every newline, or fsync every write
+SINK_SYNC_MODES = ["none", "line", "fsync"]
+SINK_SYNC = "line"
+USAGE_FILENAME = ".hey_usage.db"
+BUDGET_SCOPES = ["day", "month", "convo"]
+BUDGET_MODES = ["warn", "block"]
+COST_TOP_CONVOS = 15
+COST_DAYS = 30
+# prompt tokens per image: low is flat, high assumes a 1024px image (4 tiles)
+IMG_TOKENS = {"low": 85, "high": 765}
+# usd per 1M tokens (prompt, completion), longest matching model prefix wins
+PRICES: Dict[str, Tuple[float, float]] = {
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "gpt-4": (30.0, 60.0),
+    "gpt-4-32k": (60.0, 120.0),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4-vision-preview": (10.0, 30.0),
+    "gpt-4-1106-preview": (10.0, 30.0),
+    "gpt-4-0125-preview": (10.0, 30.0),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+}
+SNIPPETS_GC_INTERVAL = timedelta(days=1)
+# message bodies at least this long are stored once in the blob store
+BLOB_MIN = 4096
+BLOB_GC_GRACE = timedelta(days=1)
+# a live chunk stays compressed only if it shrinks to this much, inflating text that
+# barely compresses costs more load time than the bytes it saves
+CHUNK_MAX_RATIO = 0.5
+PIPE_MAX_BYTES = 512 * 1024
+PIPE_CHUNK = 64 * 1024
+MAP_REDUCE_MAX_BYTES = 64 * 1024 * 1024
+MAP_CHUNK_TOKENS = 3000
+MAP_CONCURRENCY = 4
+MAP_CACHE_TTL = timedelta(days=7)
+QUEUE_RETRIES = 3
+RATELIMIT_FILENAME = ".hey_ratelimit.db"
+RATELIMIT_POLL = 0.25
+# share of each rate limit window batch jobs leave to interactive prompts
+RATELIMIT_RESERVE = 0.1
+RATELIMIT_STALE = 30
+QUEUE_MAX_ATTEMPTS = 5
+# a convo past any of these continues in a linked child context
+ROLLOVER_KINDS = ["tokens", "messages", "bytes"]
+ROLLOVER_CARRY = ["tail", "summary"]
+# messages the child starts with when carrying the tail
+ROLLOVER_TAIL = 4
+ROLLOVER_SUMMARY = (
+    "Summarize our conversation so far for yourself, so it can continue without the "
+    "full history. Keep decisions, facts, open questions and any code that is still "
+    "being worked on."
+)
+TEMPLATES_DIRNAME = "templates"
+TEMPLATE_EXT = ".md"
+MAINTENANCE_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+TRANSPORTS = ["requests", "stdlib", "asyncio"]
+# requests is imported once a request goes out, without it stdlib is used
+HAS_REQUESTS = importlib.util.find_spec("requests") is not None
+DEFAULT_TRANSPORT = "requests" if HAS_REQUESTS else "stdlib"
+REQUEST_DEADLINE = 600.0
 
 if not OPENAIKEY:
     print(
@@ -107,13 +200,23 @@ class ContextType(TypedDict):
     start_date: Optional[str]
     end_date: Optional[str]
     md_file: Optional[str]
-    messages: List[PromptType | Any]
+    # legacy contexts stored messages inline, they now live in the chunk log
+    messages: NotRequired[List[PromptType | Any]]
+    message_count: int
+    # util.prompt_tokens of the messages, so --info needs no decompression
+    message_tokens: NotRequired[int]
+    chunks: Optional[str]
     smart_title: Optional[str]
     smart_title_slug: Optional[str]
     system: str
+    system_blob: NotRequired[str]
+    # byte offset of every user turn in md_file, md_size tells if it is stale
+    md_turns: NotRequired[List[int]]
+    md_size: NotRequired[int]
 
 
 class ConfigDict(TypedDict):
+    metrics: bool
     max_tokens: int
     codify: bool
     model: str
@@ -124,11 +227,268 @@ class ConfigDict(TypedDict):
     convo: str
     context_filename: str
     detail: str
+    transport: NotRequired[str]
+    deadline: NotRequired[float]
+    budget: NotRequired[Dict[str, float]]
+    budget_mode: NotRequired[str]
+    rollover: NotRequired[Dict[str, int]]
+    rollover_carry: NotRequired[str]
+
+
+class Telemetry:
+    # per command spans, appended as one jsonl line to METRICS_FILENAME on exit
+    enabled: bool = True
+    command: str = ""
+    spans: Dict[str, List[float]] = {}
+    trace: List[Dict[str, Any]] = []
+    requests: List[Dict[str, Any]] = []
+    stack: List[str] = []
+    marks: Dict[str, float] = {}
+
+    @staticmethod
+    @contextlib.contextmanager
+    def span(name: str, **attrs: Any):
+        start = time.perf_counter()
+        # phases are tracked for the main thread only, pool workers just record timings
+        main = threading.current_thread() is threading.main_thread()
+        if main:
+            Telemetry.stack.append(name)
+        try:
+            yield
+        finally:
+            if main:
+                Telemetry.stack.pop()
+            Telemetry.record(name, start, time.perf_counter(), **attrs)
+
+    @staticmethod
+    def timed(name: str):
+        def decorator(fn: Callable[..., Any]):
+            @functools.wraps(fn)
+            def wrapper(*args: Any, **kwargs: Any):
+                with Telemetry.span(name):
+                    return fn(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    @staticmethod
+    def record(name: str, start: float, end: float, **attrs: Any):
+        ms = (end - start) * 1000
+        count, total = Telemetry.spans.get(name, (0, 0.0))
+        Telemetry.spans[name] = [count + 1, total + ms]
+        Telemetry.trace.append(
+            {"name": name, "start_ms": (start - STARTED) * 1000, "ms": ms, **attrs}
+        )
+
+    @staticmethod
+    def since(mark: str, name: str):
+        # a span that started somewhere else, e.g. when the editor was closed
+        start = Telemetry.marks.pop(mark, None)
+        if start is not None:
+            Telemetry.record(name, start, time.perf_counter())
+
+    @staticmethod
+    def cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        prefix = max((p for p in PRICES if model.startswith(p)), key=len, default=None)
+        if prefix is None:
+            return 0.0
+        p_in, p_out = PRICES[prefix]
+        return (prompt_tokens * p_in + completion_tokens * p_out) / 1_000_000
+
+    @staticmethod
+    def request(
+        model: str,
+        usage: Dict[str, int] | None,
+        ttfb: float,
+        duration: float,
+        stream: bool = False,
+    ):
+        usage = usage or {}
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+        Telemetry.requests.append(
+            {
+                "model": model,
+                "phase": Telemetry.stack[-1] if Telemetry.stack else "",
+                "stream": stream,
+                "ttfb_ms": ttfb * 1000,
+                "ms": duration * 1000,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "cost": Telemetry.cost(model, prompt_tokens, completion_tokens),
+            }
+        )
+        if Ledger.current and usage:
+            Ledger.current.record(
+                model,
+                prompt_tokens,
+                completion_tokens,
+                Telemetry.requests[-1]["cost"],
+            )
+
+    @staticmethod
+    def entry():
+        return {
+            "ts": datetime.now().isoformat(timespec="seconds"),
+            "command": Telemetry.command,
+            "spans": {k: round(v[1], 3) for k, v in Telemetry.spans.items()},
+            "requests": Telemetry.requests,
+        }
+
+    @staticmethod
+    def flush():
+        if Telemetry.command:
+            Telemetry.record("total", STARTED, time.perf_counter())
+        trace = os.environ.get("HEY_TRACE")
+        if trace:
+            dump = json.dumps({**Telemetry.entry(), "trace": Telemetry.trace}, indent=2)
+            if trace in ("1", "-", "stderr"):
+                print(dump, file=sys.stderr)
+            else:
+                with open(trace, "w") as f:
+                    f.write(dump)
+        if not Telemetry.enabled or not Telemetry.command:
+            return
+        try:
+            with open(os.path.join(PROMPTS_DIR, METRICS_FILENAME), "a") as f:
+                f.write(json.dumps(Telemetry.entry()) + "\n")
+        except OSError:
+            pass
+
+    @staticmethod
+    def percentile(values: List[float], pct: float):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+    @staticmethod
+    def stats(days: int = 30):
+        path = os.path.join(PROMPTS_DIR, METRICS_FILENAME)
+        if not os.path.exists(path):
+            return print("no metrics recorded yet")
+        since = (datetime.now() - timedelta(days=days)).isoformat()
+        spans: Dict[str, List[float]] = {}
+        models: Dict[str, List[float]] = {}
+        per_day: Dict[str, float] = {}
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry.get("ts", "") < since:
+                    continue
+                for name, ms in entry.get("spans", {}).items():
+                    spans.setdefault(name, []).append(ms)
+                for req in entry.get("requests", []):
+                    totals = models.setdefault(req["model"], [0, 0, 0, 0.0])
+                    totals[0] += 1
+                    totals[1] += req.get("prompt_tokens", 0)
+                    totals[2] += req.get("completion_tokens", 0)
+                    totals[3] += req.get("cost", 0.0)
+                    day = entry["ts"][:10]
+                    per_day[day] = per_day.get(day, 0.0) + req.get("cost", 0.0)
+
+        print(f"last {days} days\n")
+        print(f"{'span':<16}{'count':>8}{'p50 ms':>12}{'p95 ms':>12}")
+        for name, values in sorted(spans.items()):
+            print(
+                f"{name:<16}{len(values):>8}"
+                f"{Telemetry.percentile(values, 50):>12.1f}"
+                f"{Telemetry.percentile(values, 95):>12.1f}"
+            )
+        print(f"\n{'model':<24}{'requests':>10}{'prompt':>12}", end="")
+        print(f"{'completion':>12}{'cost $':>10}")
+        for model, (count, p_tok, c_tok, cost) in sorted(models.items()):
+            print(f"{model:<24}{count:>10}{p_tok:>12}{c_tok:>12}{cost:>10.4f}")
+        print(f"\n{'day':<12}{'cost $':>10}")
+        for day, cost in sorted(per_day.items()):
+            print(f"{day:<12}{cost:>10.4f}")
+
+
+atexit.register(Telemetry.flush)
+
+
+class Profiler:
+    # cProfile plus a wall clock stack sampler, stacks start with the telemetry phase
+    interval: float = 0.001
+    path: str = ""
+    profile: Any = None
+    samples: Dict[str, int] = {}
+
+    @staticmethod
+    def from_argv():
+        # started before main so Client setup gets profiled too; argparse decides
+        # what --profile takes, and one among the prompt words is just a word
+        if not any(arg.startswith("--profile") for arg in sys.argv[1:]):
+            return
+        path = CLI.parser().parse_known_args()[0].profile
+        if path is not None:
+            Profiler.start(path)
+
+    @staticmethod
+    def start(path: str = ""):
+        if not path:
+            stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+            path = os.path.join(PROMPTS_DIR, "profiles", f"hey-{stamp}")
+        import cProfile
+
+        Profiler.path = path
+        Profiler.profile = cProfile.Profile()
+        if hasattr(signal, "setitimer"):
+            signal.signal(signal.SIGALRM, Profiler.sample)
+            signal.setitimer(signal.ITIMER_REAL, Profiler.interval, Profiler.interval)
+        atexit.register(Profiler.stop)
+        Profiler.profile.enable()
+
+    @staticmethod
+    def frame_name(frame: Any):
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+    @staticmethod
+    def sample(_signum: int, frame: Any):
+        stack: List[str] = []
+        while frame is not None:
+            stack.append(Profiler.frame_name(frame))
+            frame = frame.f_back
+        stack.reverse()
+        phases = [f"phase:{name}" for name in Telemetry.stack]
+        key = ";".join(phases + stack)
+        Profiler.samples[key] = Profiler.samples.get(key, 0) + 1
+
+    @staticmethod
+    def stop():
+        if Profiler.profile is None:
+            return
+        import pstats
+
+        Profiler.profile.disable()
+        if hasattr(signal, "setitimer"):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        os.makedirs(os.path.dirname(Profiler.path) or ".", exist_ok=True)
+        Profiler.profile.dump_stats(Profiler.path + ".pstats")
+        # flamegraph.pl / speedscope / inferno all read this collapsed format
+        with open(Profiler.path + ".collapsed", "w") as f:
+            for stack, count in sorted(Profiler.samples.items()):
+                f.write(f"{stack} {count}\n")
+        out = io.StringIO()
+        stats = pstats.Stats(Profiler.profile, stream=out)
+        stats.sort_stats("cumulative").print_stats(15)
+        print(out.getvalue(), file=sys.stderr)
+        print(
+            f"profile: {Profiler.path}.pstats {Profiler.path}.collapsed",
+            file=sys.stderr,
+        )
+        Profiler.profile = None
 
 
 # move to module
 class util:
     codify: bool = False
+    # --json: the real stdout, only json lines go there; print() goes to stderr
+    json_out: Any = None
 
     @staticmethod
     def convert_to_prompt(img_prompt: ImgPromptType | PromptType) -> PromptType:
@@ -158,45 +518,40 @@ class util:
         with open(filename, "rb") as f:
             return base64.b64encode(f.read()).decode("utf-8")
 
+    lang_to_extension = {
+        "python": ".py",
+        "javascript": ".js",
+        "java": ".java",
+        "c": ".c",
+        "cpp": ".cpp",
+        "html": ".html",
+        "css": ".css",
+        "ruby": ".rb",
+        "swift": ".swift",
+        "perl": ".pl",
+        "php": ".php",
+        "bash": ".sh",
+        "typescript": ".ts",
+        "csharp": ".cs",
+        "go": ".go",
+        "sql": ".sql",
+    }
+
     @staticmethod
     def language_annotation(markdown_text: str) -> str:
-        lang_to_extension = {
-            "python": ".py",
-            "javascript": ".js",
-            "java": ".java",
-            "c": ".c",
-            "cpp": ".cpp",
-            "html": ".html",
-            "css": ".css",
-            "ruby": ".rb",
-            "swift": ".swift",
-            "perl": ".pl",
-            "php": ".php",
-            "bash": ".sh",
-            "typescript": ".ts",
-            "csharp": ".cs",
-            "go": ".go",
-            "sql": ".sql",
-        }
+        parser = util.codify_parser()
+        return parser.feed(markdown_text) + parser.close()
 
-        def get_extension(language_line: str) -> str:
-            return lang_to_extension.get(language_line.lower(), ".txt")
+    @staticmethod
+    def codify_parser() -> "FenceParser":
+        store = SnippetStore.New()
 
-        def replacer(match: re.Match[str]) -> str:
-            s: str = match.group(0)
-            language_line: str
-            code_block: str
-            ext: str
+        def get_extension(info: str) -> str:
+            language_line = info.split()[0] if info.split() else ""
+            return util.lang_to_extension.get(language_line.lower(), ".txt")
 
-            try:
-                language_line: str = match.group(1).split("\n", 1)[0]
-                code_block = match.group(1).split("\n", 1)[1]
-                ext = get_extension(language_line)
-            except:
-                return s
-                # language_line = ""
-                # code_block = match.group(1)
-                # ext = ""
+        def annotate(info: str, code_block: str) -> str:
+            ext = get_extension(info)
 
             # generate the filename by hashing the code content
             hash_object = hashlib.sha256(code_block.encode())
@@ -208,47 +563,229 @@ class util:
                 .replace("=", "_")
             )
 
-            # create temporary file, returns file object
-            temp_dir = tempfile.mkdtemp()
-            copy_temp_file_path = os.path.join(
-                temp_dir, filename_root + ".hey_copy_codify" + ext
+            copy_temp_file_path, snippet_temp_file_path = store.put(
+                filename_root, ext, code_block
             )
-            snippet_temp_file_path = os.path.join(
-                temp_dir, filename_root + ".hey_snippet_codify" + ext
-            )
-
-            with open(copy_temp_file_path, "w") as temp_file:
-                temp_file.write(code_block)
-
-            with open(snippet_temp_file_path, "w") as temp_file:
-                temp_file.write(code_block)
 
             # Visual Studio Code link to temp file
-            return "{}\n\n [copy:]({})\n\n[snippet:]({})".format(
-                s, copy_temp_file_path, snippet_temp_file_path
+            return "\n\n [copy:]({})\n\n[snippet:]({})".format(
+                copy_temp_file_path, snippet_temp_file_path
             )
 
-        return re.sub(r"```(.*?)```", replacer, markdown_text, flags=re.DOTALL)
+        return FenceParser(annotate)
 
     @staticmethod
     def ctx_path(prompts_dir: str, convo: str):
         return os.path.join(prompts_dir, f".hey_context.{convo}.json")
 
+    @staticmethod
+    def convo_from_path(ctx_path: str):
+        return os.path.basename(ctx_path).split(".")[-2]
+
+    @staticmethod
+    def atomic_write(filename: str, data: str | bytes):
+        # readers either see the old file or the new one, never a truncated one
+        fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(filename) or ".",
+            prefix=os.path.basename(filename) + ".",
+            suffix=".tmp",
+        )
+        try:
+            try:
+                mode = os.stat(filename).st_mode & 0o777
+            except FileNotFoundError:
+                mode = 0o644
+            os.fchmod(fd, mode)
+            with os.fdopen(fd, "wb" if isinstance(data, bytes) else "w") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, filename)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
     @staticmethod
     def uuid(len: int = 8):
         return "".join(random.choices(string.ascii_letters + string.digits, k=len))
 
     @staticmethod
+    def emit(obj: Dict[str, Any]) -> None:
+        out = util.json_out or sys.stdout
+        try:
+            out.write(json.dumps(obj, ensure_ascii=False) + "\n")
+            out.flush()
+        except BrokenPipeError:
+            os.dup2(os.open(os.devnull, os.O_WRONLY), out.fileno())
+
+    @staticmethod
+    @Telemetry.timed("render")
     def log(s: str | None) -> None:
         if s is None:
             return
+        if util.json_out:
+            return util.emit({"type": "markdown", "text": s})
         if util.codify:
             s = util.language_annotation(s)
-        if os.environ.get("HEY_OUT"):
-            # if os.environ.get("HEY_OUT") != None and os.environ.get("HEY_OUT") != "":
-            print(s, file=open(os.environ["HEY_OUT"], "w"))
-        else:
+        if Sink.current:
+            return Sink.current.write(s + "\n")
+        try:
             print(s)
+            sys.stdout.flush()
+        except BrokenPipeError:
+            util.silence_stdout()
+
+    @staticmethod
+    def retryable(error: BaseException | None):
+        # network trouble, timeouts and 429/5xx answers, anywhere in the cause chain
+        while error is not None:
+            if isinstance(error, OSError) or getattr(error, "retryable", False):
+                return True
+            error = error.__cause__
+        return False
+
+    @staticmethod
+    def read_stdin(max_bytes: int = PIPE_MAX_BYTES) -> str:
+        if sys.stdin.isatty():
+            return ""
+        chunks: List[bytes] = []
+        size = 0
+        while size <= max_bytes:
+            chunk = sys.stdin.buffer.read(PIPE_CHUNK)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        data = b"".join(chunks)
+        if size > max_bytes:
+            # stop reading, the writer gets SIGPIPE instead of us buffering all of it
+            print(
+                f"stdin truncated to {max_bytes} bytes, raise it with --pipe_max",
+                file=sys.stderr,
+            )
+            data = data[:max_bytes]
+        return data.decode("utf-8", errors="replace")
+
+    @staticmethod
+    @Telemetry.timed("render")
+    def log_stream(chunks: Iterable[str]) -> None:
+        if util.json_out:
+            return util.log("".join(chunks))
+        parser = util.codify_parser() if util.codify else None
+        out: Any = Sink.current or sys.stdout
+        try:
+            for chunk in chunks:
+                out.write(parser.feed(chunk) if parser else chunk)
+            if parser:
+                out.write(parser.close())
+            out.write("\n")
+            out.flush()
+        except BrokenPipeError:
+            util.silence_stdout()
+
+    @staticmethod
+    def md_turn_offsets(md_file: str) -> List[int]:
+        # fallback for md files without an index in their context
+        offsets: List[int] = []
+        pos = 0
+        with open(md_file, "rb") as f:
+            for line in f:
+                if line.rstrip(b"\r\n") == b"### User":
+                    offsets.append(pos)
+                pos += len(line)
+        return offsets
+
+    @staticmethod
+    def md_window(md_file: str, turns: List[int], window: slice):
+        picked = range(len(turns))[window]
+        if not picked:
+            return
+        start = turns[picked[0]]
+        end = turns[picked[-1] + 1] if picked[-1] + 1 < len(turns) else None
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        with open(md_file, "rb") as f:
+            f.seek(start)
+            remaining = end - start if end is not None else -1
+            while remaining:
+                size = PIPE_CHUNK if remaining < 0 else min(PIPE_CHUNK, remaining)
+                data = f.read(size)
+                if not data:
+                    break
+                if remaining > 0:
+                    remaining -= len(data)
+                yield decoder.decode(data)
+        yield decoder.decode(b"", final=True)
+
+    @staticmethod
+    def parse_duration(value: str) -> float:
+        # "1s", "6m0s", "300ms", "1h2m3.5s" as sent in x-ratelimit-reset-*
+        units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        return sum(
+            float(n) * units[unit]
+            for n, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+        )
+
+    @staticmethod
+    def prompt_tokens(messages: List[Any]) -> int:
+        # ~4 chars per token and a few per message, images by their detail
+        tokens = 0
+        for message in messages:
+            content = message["content"]
+            tokens += 4
+            if isinstance(content, str):
+                tokens += len(content) // 4
+                continue
+            for part in content:
+                if part.get("type") == "image_url":
+                    detail = part["image_url"].get("detail", DEFAULT_DETAIL)
+                    tokens += IMG_TOKENS.get(detail, IMG_TOKENS["high"])
+                else:
+                    tokens += len(part.get("text", "")) // 4
+        return tokens
+
+    @staticmethod
+    def estimate_tokens(messages: List[Any], max_tokens: int = 0) -> int:
+        # what a request may take from the token rate limit, answer included
+        return util.prompt_tokens(messages) + max_tokens
+
+    @staticmethod
+    def today():
+        return datetime.now().strftime("%Y-%m-%d")
+
+    @staticmethod
+    def sqlite(filename: str, schema: List[str]):
+        # None without sqlite3, callers then skip what needs it
+        try:
+            import sqlite3
+        except ImportError:
+            return None
+        db = sqlite3.connect(filename, timeout=10, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        # losing the last write on a crash is fine for counters
+        db.execute("PRAGMA synchronous=NORMAL")
+        for statement in schema:
+            db.execute(statement)
+        return db
+
+    @staticmethod
+    def parse_window(value: str) -> slice:
+        # "-5:", "3:7", "10" (from turn 10 on)
+        try:
+            if ":" not in value:
+                return slice(int(value), None)
+            start, stop = value.split(":", 1)
+            return slice(int(start) if start else None, int(stop) if stop else None)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                f"invalid range '{value}', use start:stop turn numbers like 3:7 or -5:"
+            )
+
+    @staticmethod
+    def silence_stdout():
+        # the reader closed the pipe, keep python from failing on the final flush
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
 
     @staticmethod
     def date_block(date: datetime):
@@ -263,12 +800,18 @@ class util:
           """
 
     @staticmethod
-    def msg_block(prompt: PromptType):
-        role = prompt["role"]
-        content = prompt["content"]
+    def msg_head(role: str):
         return f"""
 ### {role.capitalize()}
-{content}
+"""
+
+    @staticmethod
+    def msg_block(prompt: PromptType):
+        return util.msg_head(prompt["role"]) + util.msg_tail(prompt["content"])
+
+    @staticmethod
+    def msg_tail(content: str):
+        return f"""{content}
           """
 
     @staticmethod
@@ -291,6 +834,203 @@ class util:
         return string
 
 
+class Sink:
+    # HEY_OUT: opened once per run and written as output arrives, so a watcher
+    # (tail -f, glow) sees a streamed answer grow
+    current: "Sink | None" = None
+
+    def __init__(self, filename: str, sync: str = SINK_SYNC):
+        self.filename = filename
+        self.sync = sync if sync in SINK_SYNC_MODES else SINK_SYNC
+        self.f: Any = None
+
+    @staticmethod
+    def New():
+        filename = os.environ.get("HEY_OUT")
+        if not filename:
+            return None
+        return Sink(filename, os.environ.get("HEY_OUT_SYNC", SINK_SYNC))
+
+    def write(self, s: str):
+        if self.f is None:
+            # truncated once, on the first write of the run
+            buffering = 1 if self.sync == "line" else -1
+            self.f = open(self.filename, "w", buffering=buffering, encoding="utf-8")
+        self.f.write(s)
+        if self.sync == "fsync":
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def flush(self):
+        if self.f:
+            self.f.flush()
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+
+
+Sink.current = Sink.New()
+if Sink.current:
+    atexit.register(Sink.current.close)
+
+
+class FenceParser:
+    # line based markdown fence tokenizer, fed the whole text or streamed deltas
+    OPEN = re.compile(r"^( {0,3})(`{3,}|~{3,})(.*)$")
+    # only lines that could open or close a fence go through the python loop
+    CANDIDATE = re.compile(r"^ {0,3}(?:`{3,}|~{3,}).*$", re.M)
+
+    def __init__(self, on_block: Callable[[str, str], str]):
+        self.on_block = on_block
+        self.partial = ""
+        # (fence char, fence length, opening indent, info string)
+        self.fence: Tuple[str, int, int, str] | None = None
+        self.code: List[str] = []
+
+    def feed(self, text: str) -> str:
+        if not text:
+            return ""
+        buf = self.partial + text
+        cut = buf.rfind("\n") + 1
+        self.partial = buf[cut:]
+        return self.scan(buf[:cut])
+
+    def close(self) -> str:
+        out = self.scan(self.partial)
+        # an unterminated block runs to the end and gets no annotation
+        self.partial = ""
+        self.fence = None
+        self.code = []
+        return out
+
+    def scan(self, text: str) -> str:
+        out: List[str] = []
+        pos = 0
+        for m in FenceParser.CANDIDATE.finditer(text):
+            self.content(text[pos : m.start()])
+            out.append(text[pos : m.start()])
+            end = m.end()
+            line = m.group(0)
+            # with crlf text the \r is part of the line ending, not of the line
+            cr = "\r" if line.endswith("\r") else ""
+            nl = "\n" if text.startswith("\n", end) else ""
+            out.append(self.line(line[: len(line) - len(cr)], cr + nl))
+            pos = end + len(nl)
+        self.content(text[pos:])
+        out.append(text[pos:])
+        return "".join(out)
+
+    def content(self, lines: str):
+        if self.fence is None or not lines:
+            return
+        indent = self.fence[2]
+        if not indent:
+            self.code.append(lines)
+            return
+        # content lines lose up to the opening fence's indentation
+        for line in lines.splitlines(keepends=True):
+            i = 0
+            while i < indent and i < len(line) and line[i] == " ":
+                i += 1
+            self.code.append(line[i:])
+
+    def line(self, line: str, end: str) -> str:
+        if self.fence is None:
+            m = FenceParser.OPEN.match(line)
+            # backtick fences can't have backticks in the info string (inline code)
+            if m and not (m.group(2)[0] == "`" and "`" in m.group(3)):
+                self.fence = (
+                    m.group(2)[0],
+                    len(m.group(2)),
+                    len(m.group(1)),
+                    m.group(3).strip(),
+                )
+                self.code = []
+            return line + end
+
+        char, length, _, info = self.fence
+        closing = line.strip()
+        if len(closing) >= length and closing == char * len(closing):
+            annotation = self.on_block(info, "".join(self.code))
+            if end.startswith("\r"):
+                annotation = annotation.replace("\n", "\r\n")
+            self.fence = None
+            self.code = []
+            return line + annotation + end
+
+        self.content(line + end)
+        return line + end
+
+
+class SnippetStore:
+    # content addressed codify snippets, one inode with a copy and a snippet name
+    def __init__(self, dir: str):
+        self.dir = dir
+
+    @staticmethod
+    def New():
+        return SnippetStore(os.path.join(PROMPTS_DIR, "snippets"))
+
+    def paths(self, filename_root: str, ext: str):
+        return (
+            os.path.join(self.dir, filename_root + ".hey_copy_codify" + ext),
+            os.path.join(self.dir, filename_root + ".hey_snippet_codify" + ext),
+        )
+
+    def put(self, filename_root: str, ext: str, code_block: str):
+        copy_path, snippet_path = self.paths(filename_root, ext)
+        if os.path.exists(copy_path) and os.path.exists(snippet_path):
+            # already stored, only bump it in the lru order
+            os.utime(copy_path)
+            return copy_path, snippet_path
+        os.makedirs(self.dir, exist_ok=True)
+        if not os.path.exists(copy_path):
+            util.atomic_write(copy_path, code_block)
+        if not os.path.exists(snippet_path):
+            try:
+                os.link(copy_path, snippet_path)
+            except OSError:
+                # filesystems without hard links get a second copy
+                util.atomic_write(snippet_path, code_block)
+        self.maybe_gc()
+        return copy_path, snippet_path
+
+    def maybe_gc(self):
+        marker = os.path.join(self.dir, ".gc")
+        try:
+            last = datetime.fromtimestamp(os.path.getmtime(marker))
+            if datetime.now() - last < SNIPPETS_GC_INTERVAL:
+                return
+        except FileNotFoundError:
+            pass
+        self.gc()
+        with open(marker, "w"):
+            pass
+
+    def gc(self, max_snippets: int = SNIPPETS_MAX, dry_run: bool = False):
+        if not os.path.isdir(self.dir):
+            return 0
+        copies: List[Tuple[float, str]] = []
+        with os.scandir(self.dir) as it:
+            for entry in it:
+                if ".hey_copy_codify" in entry.name:
+                    copies.append((entry.stat().st_mtime, entry.name))
+        copies.sort(reverse=True)
+        if dry_run:
+            return len(copies[max_snippets:])
+        removed = 0
+        for _, name in copies[max_snippets:]:
+            for path in (name, name.replace(".hey_copy_codify", ".hey_snippet_codify")):
+                try:
+                    os.remove(os.path.join(self.dir, path))
+                except FileNotFoundError:
+                    pass
+            removed += 1
+        return removed
+
+
 class Prompt:
     @staticmethod
     def user(content: str) -> PromptType:
@@ -300,7 +1040,12 @@ class Prompt:
         }
 
     @staticmethod
-    def user_with_imgs(content: str, imgs: List[str], detail: str) -> ImgPromptType:
+    def user_with_imgs(
+        content: str,
+        imgs: List[str],
+        detail: str,
+        built: List[ImgUpType] | None = None,
+    ) -> ImgPromptType:
         return {
             "role": "user",
             "content": [
@@ -308,7 +1053,11 @@ class Prompt:
                     "type": "text",
                     "text": content,
                 },
-                *[util.img_up_build(img, detail) for img in imgs],
+                *(
+                    built
+                    if built is not None
+                    else [util.img_up_build(img, detail) for img in imgs]
+                ),
             ],
         }
 
@@ -339,7 +1088,8 @@ class Prompt:
 
 
 class CLI:
-    def __init__(self):
+    @staticmethod
+    def parser():
         parser = argparse.ArgumentParser(
             description="CLI for model configuration and prompt management."
         )
@@ -380,15 +1130,177 @@ class CLI:
                 )
             return value
 
+        def validate_budget(value: str) -> Tuple[str, float]:
+            scope, _, usd = value.partition("=")
+            try:
+                if scope in BUDGET_SCOPES:
+                    return scope, float(usd)
+            except ValueError:
+                pass
+            raise argparse.ArgumentTypeError(
+                f"Invalid budget '{value}', use SCOPE=USD with SCOPE one of "
+                f"{', '.join(BUDGET_SCOPES)}"
+            )
+
+        def validate_rollover(value: str) -> Tuple[str, int]:
+            kind, _, n = value.partition("=")
+            if kind in ROLLOVER_KINDS and n.isdigit():
+                # the carried tail plus a turn has to fit, or every prompt rolls over
+                if kind == "messages" and 0 < int(n) <= ROLLOVER_TAIL + 2:
+                    raise argparse.ArgumentTypeError(
+                        f"Invalid rollover '{value}', messages must be 0 or more than "
+                        f"{ROLLOVER_TAIL + 2}"
+                    )
+                return kind, int(n)
+            raise argparse.ArgumentTypeError(
+                f"Invalid rollover '{value}', use KIND=N with KIND one of "
+                f"{', '.join(ROLLOVER_KINDS)}"
+            )
+
         parser.add_argument(
             "--detail", type=validate_detail, help="set image detail: high, low"
         )
 
         parser.add_argument("--stream", action="store_true", help="stream response")
+        parser.add_argument(
+            "--transport",
+            choices=TRANSPORTS,
+            help=f"set the http transport, defaults to {DEFAULT_TRANSPORT}",
+        )
+        parser.add_argument(
+            "--deadline",
+            type=float,
+            help=(
+                "set the request deadline in seconds for the stdlib and asyncio "
+                f"transports, defaults to {REQUEST_DEADLINE:g}"
+            ),
+        )
+        parser.add_argument(
+            "--pipe",
+            action="store_true",
+            help=(
+                "read the prompt from stdin (appended to the sentence) and stream "
+                "plain tokens to stdout, does not save prompts"
+            ),
+        )
+        parser.add_argument(
+            "--pipe_max",
+            type=int,
+            help=(
+                f"max bytes read from stdin, defaults to {PIPE_MAX_BYTES} for --pipe "
+                f"and {MAP_REDUCE_MAX_BYTES} for --map_reduce"
+            ),
+        )
+        parser.add_argument(
+            "--map_reduce",
+            action="store_true",
+            help=(
+                "split stdin into chunks, run the prompt on each concurrently and "
+                "combine the answers, does not save prompts"
+            ),
+        )
+        parser.add_argument(
+            "--chunk_tokens",
+            type=int,
+            default=MAP_CHUNK_TOKENS,
+            help=(
+                f"approx tokens per --map_reduce chunk, defaults to {MAP_CHUNK_TOKENS}"
+            ),
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=MAP_CONCURRENCY,
+            help=(
+                "parallel requests for --map_reduce and --flush_queue, defaults to "
+                f"{MAP_CONCURRENCY}"
+            ),
+        )
+
+        parser.add_argument(
+            "--queue",
+            action="store_true",
+            help="keep the prompt on disk instead of sending it, see --flush_queue",
+        )
+        parser.add_argument(
+            "--flush_queue",
+            action="store_true",
+            help=(
+                "send queued prompts, --concurrency at a time, and add the answers to "
+                "their convos"
+            ),
+        )
+
+        parser.add_argument(
+            "--tpl",
+            type=str,
+            metavar="NAME",
+            help=(
+                "render the template NAME as the prompt, with key=value, key=@file or "
+                "key=@- (stdin) after it"
+            ),
+        )
+        parser.add_argument(
+            "--tpl_batch",
+            type=str,
+            metavar="FILE",
+            help=(
+                "with --tpl, render one prompt per json line of FILE (- for stdin) "
+                "and send them --concurrency at a time"
+            ),
+        )
+        parser.add_argument(
+            "--templates",
+            action="store_true",
+            help="list templates and their variables",
+        )
+
+        parser.add_argument(
+            "--rollover",
+            type=validate_rollover,
+            action="append",
+            metavar="KIND=N",
+            help=(
+                "continue a convo in a linked new one past N "
+                f"{', '.join(ROLLOVER_KINDS)}, 0 removes it, off by default"
+            ),
+        )
+        parser.add_argument(
+            "--rollover_carry",
+            choices=ROLLOVER_CARRY,
+            help=(
+                f"what the new convo starts with: the last {ROLLOVER_TAIL} messages or "
+                "a summary, defaults to tail"
+            ),
+        )
+        parser.add_argument(
+            "--chain",
+            action="store_true",
+            help="list the parts of the current convo, oldest first",
+        )
 
         parser.add_argument("--delete_convo", type=str, help="delete prompt convo")
 
-        parser.add_argument("--fork", action="store_true", help="fork prompt convo")
+        parser.add_argument(
+            "--fork",
+            type=str,
+            nargs="?",
+            const="",
+            metavar="NAME",
+            help=(
+                "keep the current point of the convo as a named branch and stay on "
+                "the current one"
+            ),
+        )
+        parser.add_argument(
+            "--branches", action="store_true", help="list the branches of the convo"
+        )
+        parser.add_argument(
+            "--branch", type=str, help="switch the convo to the given branch"
+        )
+        parser.add_argument(
+            "--branch_md", type=str, help="output the given branch as markdown"
+        )
 
         parser.add_argument(
             "--archive", action="store_true", help="move all convos to archive"
@@ -403,6 +1315,14 @@ class CLI:
         parser.add_argument(
             "--tidy", action="store_true", help="tidy orphaned contexts"
         )
+        parser.add_argument(
+            "--dry_run",
+            action="store_true",
+            help=(
+                "with --archive or --tidy, only report what would be moved or "
+                "removed, with --tpl_batch only render the prompts"
+            ),
+        )
         parser.add_argument("--pins", action="store_true", help="list all pins")
         parser.add_argument(
             "--pin", action="store_true", help="pin the current context"
@@ -434,6 +1354,19 @@ class CLI:
             "--img", type=str, action="append", help="upload and query image"
         )
         parser.add_argument("--show", type=str, help="show prompt convo")
+        parser.add_argument(
+            "--tail",
+            type=int,
+            help="with --show or --recent, only output the last <n> turns",
+        )
+        parser.add_argument(
+            "--range",
+            type=util.parse_window,
+            help=(
+                "with --show or --recent, only output turns start:stop (0 based, "
+                "negative counts from the end)"
+            ),
+        )
         parser.add_argument(
             "--ctx", type=str, nargs=argparse.ZERO_OR_MORE, help="show prompt context"
         )
@@ -471,18 +1404,83 @@ class CLI:
             "--retry", action="store_true", help="retry the last prompt"
         )
         parser.add_argument("--init", action="store_true", help="init the last prompt")
+        parser.add_argument(
+            "--profile",
+            metavar="PATH",
+            nargs="?",
+            const="",
+            help=(
+                "write cProfile pstats and flamegraph collapsed stacks of this run "
+                "to PATH, defaults to <prompts dir>/profiles"
+            ),
+        )
+        parser.add_argument(
+            "--stats",
+            action="store_true",
+            help="latency percentiles, tokens and cost from the local metrics log",
+        )
+        parser.add_argument(
+            "--json",
+            action="store_true",
+            help=(
+                "write json lines to stdout: answers with usage, stream deltas, convo "
+                "listings, --ctx and --info"
+            ),
+        )
+        parser.add_argument(
+            "--cost",
+            type=int,
+            nargs="?",
+            const=COST_DAYS,
+            metavar="DAYS",
+            help=(
+                "spend by model, convo and day over the last DAYS, defaults to "
+                f"{COST_DAYS}"
+            ),
+        )
+        parser.add_argument(
+            "--budget",
+            type=validate_budget,
+            action="append",
+            metavar="SCOPE=USD",
+            help=f"set a spend limit per {', '.join(BUDGET_SCOPES)}, 0 removes it",
+        )
+        parser.add_argument(
+            "--budget_mode",
+            choices=BUDGET_MODES,
+            help="warn or block prompts that would go over a budget, defaults to warn",
+        )
         parser.add_argument(
             "sentence",
             nargs=argparse.REMAINDER,
             default=None,
             help="Capture remaining input after flags",
         )
-        args = parser.parse_args()
+        return parser
+
+    @Telemetry.timed("cli_parse")
+    def __init__(self):
+        args = CLI.parser().parse_args()
 
         self.get_model = args.get_model
         self.codify = args.codify
         self.codify_on = args.codify_on
         self.stream = args.stream
+        self.transport = args.transport
+        self.deadline = args.deadline
+        self.pipe = args.pipe
+        self.pipe_max = args.pipe_max
+        self.map_reduce = args.map_reduce
+        self.chunk_tokens = args.chunk_tokens
+        self.concurrency = args.concurrency
+        self.queue = args.queue
+        self.flush_queue = args.flush_queue
+        self.rollover = args.rollover
+        self.rollover_carry = args.rollover_carry
+        self.chain = args.chain
+        self.tpl = args.tpl
+        self.tpl_batch = args.tpl_batch
+        self.templates = args.templates
         self.codify_off = args.codify_off
         self.qk = args.qk
         self.new_convo = args.new_convo
@@ -492,6 +1490,7 @@ class CLI:
         self.retry = args.retry
         self.set_model = args.set_model
         self.show = args.show
+        self.window: slice | None = slice(-args.tail, None) if args.tail else args.range
         self.convos_with_files = args.convos_with_files
         self.temp = args.temp
         self.set_convo = args.set_convo
@@ -499,11 +1498,15 @@ class CLI:
         self.reset = args.reset
         self.show_ctx = args.ctx
         self.tidy = args.tidy
+        self.dry_run = args.dry_run
         self.unpin = args.unpin
         self.archive = args.archive
         self.recent = args.recent
         self.init = args.init
         self.fork = args.fork
+        self.branches = args.branches
+        self.branch = args.branch
+        self.branch_md = args.branch_md
         self.detail = args.detail
         self.convos = args.convos
         self.qk4 = args.qk4
@@ -519,7 +1522,84 @@ class CLI:
         self.one_shot = args.one_shot
         self.info = args.info
         self.dir = args.dir
+        self.stats = args.stats
+        self.json = args.json
+        self.cost = args.cost
+        self.budget = args.budget
+        self.budget_mode = args.budget_mode
         self.sentence = " ".join(args.sentence) if args.sentence else None
+        self.words: List[str] = args.sentence or []
+
+
+Profiler.from_argv()
+
+
+class FileCache:
+    # parsed file contents for this process, valid while (mtime_ns, size, inode) match
+    entries: Dict[str, Tuple[Tuple[int, int, int], Any]] = {}
+    parses: Dict[str, int] = {}
+    hits: int = 0
+
+    @staticmethod
+    def key(st: os.stat_result):
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    @staticmethod
+    def load(filename: str, parse: Callable[[bytes], Any]) -> Any:
+        entry = FileCache.entries.get(filename)
+        if entry is not None and entry[0] == FileCache.key(os.stat(filename)):
+            FileCache.hits += 1
+            return entry[1]
+        with open(filename, "rb") as f:
+            key = FileCache.key(os.fstat(f.fileno()))
+            value = parse(f.read())
+        FileCache.parses[filename] = FileCache.parses.get(filename, 0) + 1
+        FileCache.entries[filename] = (key, value)
+        return value
+
+    @staticmethod
+    def put(filename: str, value: Any):
+        # after our own write we already know the contents, no need to parse them back
+        try:
+            FileCache.entries[filename] = (FileCache.key(os.stat(filename)), value)
+        except FileNotFoundError:
+            FileCache.entries.pop(filename, None)
+
+    @staticmethod
+    def invalidate(filename: str):
+        FileCache.entries.pop(filename, None)
+
+    @staticmethod
+    def report():
+        total = sum(FileCache.parses.values())
+        print(f"cache: parses={total} hits={FileCache.hits}", file=sys.stderr)
+        for filename, count in sorted(FileCache.parses.items()):
+            print(f"  {count} {filename}", file=sys.stderr)
+
+
+if os.environ.get("HEY_CACHE_STATS"):
+    atexit.register(FileCache.report)
+
+
+class FileLock:
+    def __init__(self, filename: str, shared: bool = False):
+        self.filename = filename
+        self.shared = shared
+        self.fd: int | None = None
+
+    def __enter__(self):
+        self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *_: Any):
+        if self.fd is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
 
 
 class PropsMixin:
@@ -528,12 +1608,25 @@ class PropsMixin:
         if not filename:
             raise Exception("PropsMixin: error=filename is required")
         self.filename = filename
+        # snapshot of what we last read or wrote, used to find our own changes
+        self._loaded: Dict[str, Any] = {}
+
+    @property
+    def lock_filename(self):
+        return os.path.splitext(self.filename)[0] + ".lock"
+
+    @property
+    def version(self) -> int:
+        return self.obj.get("version") or 0
 
     def merge(self, other_obj: Dict[str, str]):
         self.obj = {**self.obj, **other_obj}
 
+    def serialize(self) -> Dict[str, Any]:
+        return self.obj
+
     def to_json(self):
-        return json.dumps(self.obj)
+        return json.dumps(self.serialize())
 
     def from_json(self, json_str: str, merge: bool = True):
         o = json.loads(json_str)
@@ -543,12 +1636,43 @@ class PropsMixin:
             self.obj = o
 
     def save(self):
-        with open(self.filename, "w+") as f:
-            f.write(self.to_json())
+        # writers serialise per file, readers never lock thanks to atomic renames
+        with FileLock(self.lock_filename):
+            disk = self.read_disk()
+            if disk is not None and (disk.get("version") or 0) != self.version:
+                self.resolve_conflict(disk)
+            self.obj["version"] = self.version + 1
+            self.write()
+            self.mark_loaded()
+
+    def write(self):
+        data = self.serialize()
+        util.atomic_write(self.filename, json.dumps(data))
+        FileCache.put(self.filename, data)
+
+    def read_disk(self) -> Dict[str, Any] | None:
+        try:
+            return dict(FileCache.load(self.filename, json.loads))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def resolve_conflict(self, disk: Dict[str, Any]):
+        # someone saved since we read: keep their fields, reapply the ones we changed
+        changed = {
+            k: v
+            for k, v in self.obj.items()
+            if k != "version" and (k not in self._loaded or self._loaded[k] != v)
+        }
+        self.obj = {**self.obj, **disk, **changed}
+
+    def mark_loaded(self):
+        # values are replaced, never mutated in place, so a shallow copy is enough
+        self._loaded = dict(self.obj)
 
     def open(self):
-        with open(self.filename, "r") as f:
-            self.from_json(f.read())
+        with Telemetry.span(type(self).__name__.lower() + "_load"):
+            self.merge(FileCache.load(self.filename, json.loads))
+        self.mark_loaded()
 
     def get_date(self, key: str):
         if self.obj.get(key) is None:
@@ -576,6 +1700,7 @@ class Config(PropsMixin):
         detail: str = DEFAULT_DETAIL,
     ):
         obj: ConfigDict = {
+            "metrics": True,
             "codify": False,
             "model": "gpt-3.5-turbo",
             "temp": 7,
@@ -586,6 +1711,8 @@ class Config(PropsMixin):
             "convo": convo,
             "context_filename": ctx_filename,
             "detail": detail,
+            "transport": DEFAULT_TRANSPORT,
+            "deadline": REQUEST_DEADLINE,
         }
         self.obj = obj
         super().__init__(
@@ -596,30 +1723,32 @@ class Config(PropsMixin):
     def remove_pin(self, pin: str = ""):
         pin = pin or self.obj["convo"]
         if pin in self.obj["pins"]:
-            self.obj["pins"].remove(pin)
+            self.obj["pins"] = [p for p in self.obj["pins"] if p != pin]
             self.save()
 
     def add_pin(self, pin: str = ""):
         pin = pin or self.obj["convo"]
         if pin not in self.obj["pins"]:
-            self.obj["pins"].append(pin)
+            self.obj["pins"] = [*self.obj["pins"], pin]
             self.save()
 
-    def list_context_files(self):
+    def scan_context_files(self):
         dir: str = self.prompts_dir or PROMPTS_DIR
-        all_files = sorted(
-            [
-                os.path.join(dir, f)
-                for f in os.listdir(dir)
-                if f.startswith(".hey_context.")
-            ],
-            key=os.path.getmtime,
-            reverse=True,
-        )
-        return all_files
+        with os.scandir(dir) as it:
+            for entry in it:
+                if entry.name.startswith(".hey_context.") and entry.name.endswith(
+                    ".json"
+                ):
+                    yield entry
+
+    def list_context_files(self, sort: bool = True):
+        entries = list(self.scan_context_files())
+        if sort:
+            entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+        return [e.path for e in entries]
 
     def list_convos(self):
-        return [f.split(".")[-2] for f in self.list_context_files()]
+        return [util.convo_from_path(f) for f in self.list_context_files()]
 
     @property
     def max_tokens(self):
@@ -648,6 +1777,62 @@ class Config(PropsMixin):
         self.obj["detail"] = value
         self.save()
 
+    @property
+    def transport(self):
+        transport = self.obj.get("transport", DEFAULT_TRANSPORT)
+        # a config written where requests was installed keeps working without it
+        return "stdlib" if transport == "requests" and not HAS_REQUESTS else transport
+
+    @transport.setter
+    def transport(self, value: str):
+        self.obj["transport"] = value
+        self.save()
+
+    @property
+    def deadline(self):
+        return self.obj.get("deadline", REQUEST_DEADLINE)
+
+    @deadline.setter
+    def deadline(self, value: float):
+        self.obj["deadline"] = value
+        self.save()
+
+    @property
+    def budget(self) -> Dict[str, float]:
+        return self.obj.get("budget", {})
+
+    @budget.setter
+    def budget(self, value: Dict[str, float]):
+        self.obj["budget"] = value
+        self.save()
+
+    @property
+    def rollover(self) -> Dict[str, int]:
+        return self.obj.get("rollover", {})
+
+    @rollover.setter
+    def rollover(self, value: Dict[str, int]):
+        self.obj["rollover"] = value
+        self.save()
+
+    @property
+    def rollover_carry(self):
+        return self.obj.get("rollover_carry", ROLLOVER_CARRY[0])
+
+    @rollover_carry.setter
+    def rollover_carry(self, value: str):
+        self.obj["rollover_carry"] = value
+        self.save()
+
+    @property
+    def budget_mode(self):
+        return self.obj.get("budget_mode", BUDGET_MODES[0])
+
+    @budget_mode.setter
+    def budget_mode(self, value: str):
+        self.obj["budget_mode"] = value
+        self.save()
+
     @property
     def context_filename(self):
         return self.obj["context_filename"]
@@ -675,8 +1860,26 @@ class Config(PropsMixin):
 
     @convo.setter
     def convo(self, value: str):
+        # switching only swaps the pointer file, the config itself is not rewritten
         self.obj["convo"] = value
-        self.save()
+        self.obj["context_filename"] = util.ctx_path(self.prompts_dir, value)
+        util.atomic_write(self.active_filename, value)
+
+    @property
+    def active_filename(self):
+        return os.path.join(self.prompts_dir or PROMPTS_DIR, ACTIVE_FILENAME)
+
+    def open(self):
+        super().open()
+        try:
+            with open(self.active_filename) as f:
+                convo = f.read().strip()
+        except FileNotFoundError:
+            return
+        # the pointer wins over the convo saved in the config
+        if convo:
+            self.obj["convo"] = convo
+            self.obj["context_filename"] = util.ctx_path(self.prompts_dir, convo)
 
     @property
     def temp(self):
@@ -720,23 +1923,500 @@ class Config(PropsMixin):
         self.save()
 
 
+class ConvoIndex(PropsMixin):
+    # convo id -> [smart_title, md_file, mtime_ns] of its context header, so
+    # listings stat each context instead of parsing it
+    def __init__(self, prompts_dir: str = PROMPTS_DIR):
+        self.prompts_dir = prompts_dir
+        obj: Dict[str, Any] = {}
+        super().__init__(obj, os.path.join(prompts_dir, INDEX_FILENAME))
+
+    @staticmethod
+    def New(prompts_dir: str = PROMPTS_DIR):
+        index = ConvoIndex(prompts_dir)
+        if os.path.exists(index.filename):
+            index.open()
+        return index
+
+    def titles(self, convos: List[str], complete: bool = False):
+        titles: List[Tuple[str, str, str]] = []
+        dirty = False
+        for convo in convos:
+            path = util.ctx_path(self.prompts_dir, convo)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                titles.append((convo, "unknown", ""))
+                continue
+            entry = self.obj.get(convo)
+            if not entry or entry[2] != mtime:
+                j = FileCache.load(path, json.loads)
+                entry = [j["smart_title"], j["md_file"], mtime]
+                self.obj[convo] = entry
+                dirty = True
+            titles.append((convo, entry[0], entry[1]))
+        if complete:
+            # a full listing, drop convos that were deleted, archived or tidied
+            stale = set(self.obj) - set(convos) - {"version"}
+            for convo in stale:
+                del self.obj[convo]
+            dirty = dirty or bool(stale)
+        if dirty:
+            self.save()
+        return titles
+
+
+class ChunkLog:
+    # record layout: >IB (payload length, codec) followed by the payload
+    RECORD = struct.Struct(">IB")
+    RAW = 0
+    ZLIB = 1
+    ZSTD = 2
+
+    def __init__(self, filename: str):
+        self.filename = filename
+
+    @staticmethod
+    def encode(
+        payload: Any, level: int = 6, max_ratio: float = CHUNK_MAX_RATIO
+    ) -> bytes:
+        data = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+        if zstandard is not None:
+            codec = ChunkLog.ZSTD
+            body = zstandard.ZstdCompressor(level=level * 2).compress(data)
+        else:
+            codec = ChunkLog.ZLIB
+            body = zlib.compress(data, level)
+        if len(body) > len(data) * max_ratio:
+            codec, body = ChunkLog.RAW, data
+        return ChunkLog.RECORD.pack(len(body), codec) + body
+
+    @staticmethod
+    def decode(codec: int, body: bytes) -> Any:
+        if codec == ChunkLog.ZLIB:
+            body = zlib.decompress(body)
+        elif codec == ChunkLog.ZSTD:
+            if zstandard is None:
+                raise Exception(
+                    "ChunkLog: error=zstd chunk found, pip install zstandard"
+                )
+            body = zstandard.ZstdDecompressor().decompress(body)
+        return json.loads(body)
+
+    @staticmethod
+    def read_records(f: Any):
+        while True:
+            head = f.read(ChunkLog.RECORD.size)
+            if len(head) < ChunkLog.RECORD.size:
+                return
+            length, codec = ChunkLog.RECORD.unpack(head)
+            body = f.read(length)
+            # a torn append from a crashed writer, everything before it is intact
+            if len(body) < length:
+                return
+            yield ChunkLog.decode(codec, body)
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    @staticmethod
+    def parse(data: bytes) -> List[Any]:
+        messages: List[Any] = []
+        for chunk in ChunkLog.read_records(io.BytesIO(data)):
+            messages.extend(chunk)
+        return messages
+
+    def read(self) -> List[Any]:
+        try:
+            return list(FileCache.load(self.filename, ChunkLog.parse))
+        except FileNotFoundError:
+            return []
+
+    def append(self, messages: List[Any]):
+        if not messages:
+            return
+        with open(self.filename, "ab") as f:
+            f.write(ChunkLog.encode(messages))
+
+    def rewrite(self, messages: List[Any]):
+        util.atomic_write(self.filename, ChunkLog.encode(messages) if messages else b"")
+
+    def remove(self):
+        FileCache.invalidate(self.filename)
+        if self.exists():
+            os.remove(self.filename)
+
+
+class BlobStore:
+    # content addressed message bodies shared by every context, gc'd by --tidy
+    cache: Dict[str, str] = {}
+
+    def __init__(self, dir: str):
+        self.dir = dir
+
+    @staticmethod
+    def New(prompts_dir: str = PROMPTS_DIR):
+        return BlobStore(os.path.join(prompts_dir, "blobs"))
+
+    def path(self, digest: str):
+        return os.path.join(self.dir, digest[:2], digest)
+
+    @staticmethod
+    def digest(content: str) -> str:
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def put(self, content: str) -> str:
+        digest = BlobStore.digest(content)
+        path = self.path(digest)
+        if os.path.exists(path):
+            # keeps a reused blob out of gc's grace window
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            util.atomic_write(path, ChunkLog.encode(content))
+        BlobStore.cache[digest] = content
+        return digest
+
+    def get(self, digest: str) -> str:
+        if digest not in BlobStore.cache:
+            with open(self.path(digest), "rb") as f:
+                BlobStore.cache[digest] = next(ChunkLog.read_records(f))
+        return BlobStore.cache[digest]
+
+    def pack(self, messages: List[Any], min_size: int = BLOB_MIN):
+        packed: List[Any] = []
+        digests: set[str] = set()
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, str) and len(content) >= min_size:
+                digest = self.put(content)
+                digests.add(digest)
+                message = {k: v for k, v in message.items() if k != "content"}
+                message["blob"] = digest
+            packed.append(message)
+        return packed, digests
+
+    def unpack(self, messages: List[Any]) -> List[Any]:
+        return [
+            {
+                **{k: v for k, v in m.items() if k != "blob"},
+                "content": self.get(m["blob"]),
+            }
+            if "blob" in m
+            else m
+            for m in messages
+        ]
+
+    def gc(
+        self,
+        referenced: set[str],
+        grace: timedelta = BLOB_GC_GRACE,
+        dry_run: bool = False,
+    ):
+        if not os.path.isdir(self.dir):
+            return 0
+        # a blob written just before its context header is not referenced yet
+        cutoff = (datetime.now() - grace).timestamp()
+        removed = 0
+        for shard in os.scandir(self.dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name in referenced or entry.stat().st_mtime >= cutoff:
+                    continue
+                if not dry_run:
+                    os.remove(entry.path)
+                removed += 1
+        return removed
+
+
+class ContextPack:
+    # magic, records, json index, >Q index offset
+    MAGIC = b"HEYPACK1"
+    TRAILER = struct.Struct(">Q")
+
+    def __init__(self, filename: str):
+        self.filename = filename
+
+    def write(self, contexts: List[Tuple[str, Dict[str, Any]]]):
+        index: List[Dict[str, Any]] = []
+        with open(self.filename, "wb") as f:
+            f.write(ContextPack.MAGIC)
+            for convo, obj in contexts:
+                offset = f.tell()
+                f.write(ChunkLog.encode(obj, level=9, max_ratio=1))
+                index.append(
+                    {
+                        "convo": convo,
+                        "smart_title": obj.get("smart_title"),
+                        "md_file": obj.get("md_file"),
+                        "offset": offset,
+                    }
+                )
+            index_offset = f.tell()
+            f.write(json.dumps(index).encode("utf-8"))
+            f.write(ContextPack.TRAILER.pack(index_offset))
+            # the loose files are removed right after, the pack must be on disk first
+            f.flush()
+            os.fsync(f.fileno())
+
+    def index(self) -> List[Dict[str, Any]]:
+        with open(self.filename, "rb") as f:
+            if f.read(len(ContextPack.MAGIC)) != ContextPack.MAGIC:
+                raise Exception(f"ContextPack: error=not a pack file {self.filename}")
+            f.seek(-ContextPack.TRAILER.size, os.SEEK_END)
+            end = f.tell()
+            (index_offset,) = ContextPack.TRAILER.unpack(f.read())
+            f.seek(index_offset)
+            return json.loads(f.read(end - index_offset))
+
+    def read(self, convo: str) -> Dict[str, Any] | None:
+        for entry in self.index():
+            if entry["convo"] != convo:
+                continue
+            with open(self.filename, "rb") as f:
+                f.seek(entry["offset"])
+                return next(ChunkLog.read_records(f), None)
+        return None
+
+
 class Context(PropsMixin):
     def __init__(self, prompts_dir: str = PROMPTS_DIR, convo: str = DEFAULT_CONVO):
         obj: ContextType = {
             "start_date": datetime.now().isoformat(),
             "end_date": None,
             "md_file": None,
-            "messages": [],
+            "message_count": 0,
+            "chunks": None,
             "smart_title": None,
             "smart_title_slug": None,
             "system": "You are a helpful assistant",
         }
         self.obj = obj
+        # messages are decompressed lazily, metadata reads only touch the header
+        self._messages: List[Any] | None = []
+        self._persisted: List[Any] | None = None
+        # node index in the chunk log of every message in _persisted
+        self._path: List[int] = []
+        self._persisted_path: str | None = None
+        self._source: str | None = None
         super().__init__(
             obj,
             util.ctx_path(prompts_dir, convo),
         )
 
+    @property
+    def chunks_filename(self):
+        return os.path.splitext(self.filename)[0] + ".chunks"
+
+    def chunk_log(self):
+        return ChunkLog(self.chunks_filename)
+
+    def blob_store(self):
+        return BlobStore.New(os.path.dirname(self.filename))
+
+    def read_log(self, filename: str) -> List[Any]:
+        return self.blob_store().unpack(ChunkLog(filename).read())
+
+    @staticmethod
+    def parent(nodes: List[Any], i: int) -> int:
+        # logs written before branching have no "p", they are one straight line
+        return nodes[i].get("p", i - 1)
+
+    @staticmethod
+    def walk(nodes: List[Any], head: int) -> List[int]:
+        path: List[int] = []
+        while head >= 0:
+            path.append(head)
+            # Context.parent inlined, this runs once per message on every load
+            head = nodes[head].get("p", head - 1)
+        path.reverse()
+        return path
+
+    @staticmethod
+    def strip(node: Dict[str, Any]) -> Dict[str, Any]:
+        node = node.copy()
+        node.pop("p", None)
+        return node
+
+    def head_of(self, nodes: List[Any], head: int | None = None) -> int:
+        head = self.obj.get("head") if head is None else head
+        return len(nodes) - 1 if head is None or head >= len(nodes) else head
+
+    @property
+    def head(self) -> int:
+        self.messages
+        return self._path[-1] if self._path else -1
+
+    def serialize(self) -> Dict[str, Any]:
+        # older headers kept a "blobs" list, gc reads the chunk log instead
+        header = {
+            k: v
+            for k, v in self.obj.items()
+            if k not in ("messages", "system_blob", "blobs")
+        }
+        if self._messages is not None:
+            header["message_count"] = len(self._messages)
+            header["message_tokens"] = util.prompt_tokens(self._messages)
+        header["chunks"] = os.path.basename(self.chunks_filename)
+        system = header.get("system")
+        if Context.blob_system(system):
+            # only named here, write() puts it in the store
+            header["system"] = None
+            header["system_blob"] = BlobStore.digest(system)
+        return header
+
+    @staticmethod
+    def blob_system(system: Any):
+        return isinstance(system, str) and len(system) >= BLOB_MIN
+
+    def to_dict(self) -> Dict[str, Any]:
+        # self contained, archive packs must not depend on the blob store
+        header = self.serialize()
+        header.pop("system_blob", None)
+        obj = {**header, "system": self.system, "messages": self.messages}
+        nodes = self.read_log(self._source or self.chunks_filename)
+        if len(nodes) > len(self.messages):
+            obj["nodes"] = nodes
+        return obj
+
+    def open(self):
+        with Telemetry.span("context_load"):
+            self.merge(FileCache.load(self.filename, json.loads))
+        legacy = self.obj.pop("messages", None)
+        if self.obj.get("system") is None and self.obj.get("system_blob"):
+            self.obj["system"] = self.blob_store().get(self.obj["system_blob"])
+        self._messages = legacy
+        self._persisted = None
+        self._path = []
+        self._persisted_path = None
+        self._source = self.chunks_filename
+        self.mark_loaded()
+
+    def write(self):
+        self.save_messages()
+        if Context.blob_system(self.obj.get("system")):
+            self.blob_store().put(self.obj["system"])
+        super().write()
+
+    def resolve_conflict(self, disk: Dict[str, Any]):
+        disk.pop("messages", None)
+        super().resolve_conflict(disk)
+        ours = self._messages
+        base = self._persisted
+        log = self.chunk_log()
+        if ours is None or base is None or self._persisted_path != log.filename:
+            return
+        nodes = self.read_log(log.filename)
+        theirs = Context.walk(nodes, self.head_of(nodes, disk.get("head")))
+        appended_only = len(ours) >= len(base) and all(
+            a is b for a, b in zip(ours, base)
+        )
+        # they only added turns on top of ours, put ours after theirs; anything
+        # else stays where it is on disk, as a branch
+        if appended_only and theirs[: len(self._path)] == self._path:
+            persisted = [Context.strip(nodes[i]) for i in theirs]
+            self._messages = persisted + ours[len(base) :]
+            self._persisted = persisted
+            self._path = theirs
+
+    def save_messages(self):
+        log = self.chunk_log()
+        if self._messages is None and self._source in (None, log.filename):
+            return
+        # still lazy but saving under a new name, so materialise first
+        msgs = self.messages
+        store = self.blob_store()
+        if self._persisted_path not in (None, log.filename):
+            # a new file only gets the active branch, as one straight line
+            packed, _ = store.pack(msgs)
+            log.rewrite(packed)
+            nodes = [{**m, "p": i - 1} for i, m in enumerate(msgs)]
+            self.obj["branches"] = {}
+        else:
+            # nodes are only ever appended: keep the prefix we share with what is
+            # on disk and hang everything after it off that node as a new branch
+            nodes = self.read_log(log.filename)
+            persisted = self._persisted or []
+            shared = 0
+            while (
+                shared < min(len(msgs), len(persisted))
+                and msgs[shared] is persisted[shared]
+            ):
+                shared += 1
+            parent = self._path[shared - 1] if shared else -1
+            added: List[Any] = []
+            for m in msgs[shared:]:
+                added.append({**m, "p": parent})
+                parent = len(nodes) + len(added) - 1
+            packed, _ = store.pack(added)
+            log.append(packed)
+            nodes = nodes + added
+            self.obj["head"] = parent
+        FileCache.put(log.filename, nodes)
+        self._persisted = list(msgs)
+        self._path = Context.walk(nodes, self.head_of(nodes))
+        self._persisted_path = log.filename
+        self._source = log.filename
+
+    def branches(self) -> List[Tuple[int, List[str], List[Any]]]:
+        # every leaf, named node and the active one, each with the messages on its path
+        nodes = self.read_log(self._source or self.chunks_filename)
+        parents = {Context.parent(nodes, i) for i in range(len(nodes))}
+        names: Dict[int, List[str]] = {}
+        for name, tip in (self.obj.get("branches") or {}).items():
+            names.setdefault(tip, []).append(name)
+        leaves = {i for i in range(len(nodes)) if i not in parents}
+        tips = sorted((leaves | set(names) | {self.head_of(nodes)}) - {-1})
+        return [
+            (
+                tip,
+                names.get(tip, []),
+                [Context.strip(nodes[i]) for i in Context.walk(nodes, tip)],
+            )
+            for tip in tips
+        ]
+
+    def add_branch(self, name: str):
+        # the tip has to be on disk before it can be named
+        self.messages
+        self.save()
+        self.obj["branches"] = {**(self.obj.get("branches") or {}), name: self.head}
+        self.save()
+
+    def set_head(self, tip: int):
+        self.obj["head"] = tip
+        self._messages = None
+        self._source = self.chunks_filename
+        self.messages
+        self.save()
+
+    def set_md_index(self, turns: List[int], size: int):
+        self.obj["md_turns"] = turns
+        self.obj["md_size"] = size
+        self.save()
+
+    def md_turns(self, md_file: str) -> List[int]:
+        turns = self.obj.get("md_turns")
+        if (
+            turns is not None
+            and self.md_file == md_file
+            and self.obj.get("md_size") == os.path.getsize(md_file)
+        ):
+            return turns
+        return util.md_turn_offsets(md_file)
+
+    def files(self) -> List[str]:
+        paths = [self.filename, self.chunks_filename, self.lock_filename]
+        return [p for p in paths if os.path.exists(p)]
+
+    def remove(self):
+        self.chunk_log().remove()
+        FileCache.invalidate(self.filename)
+        for f in (self.filename, self.lock_filename):
+            if os.path.exists(f):
+                os.remove(f)
+
     @staticmethod
     def New(
         prompts_dir: str = PROMPTS_DIR,
@@ -744,6 +2424,10 @@ class Context(PropsMixin):
     ):
         return Context(convo=convo, prompts_dir=prompts_dir)
 
+    @property
+    def convo(self):
+        return util.convo_from_path(self.filename)
+
     @property
     def md_file(self):
         return self.obj["md_file"]
@@ -766,8 +2450,29 @@ class Context(PropsMixin):
         return self.obj["smart_title_slug"]
 
     @property
-    def messages(self):
-        return self.obj["messages"]
+    def messages(self) -> List[Any]:
+        if self._messages is None:
+            source = self._source or self.chunks_filename
+            with Telemetry.span("messages_load"):
+                nodes = self.read_log(source)
+                self._path = Context.walk(nodes, self.head_of(nodes))
+                self._messages = [Context.strip(nodes[i]) for i in self._path]
+            self._persisted = list(self._messages)
+            self._persisted_path = source
+        return self._messages
+
+    @property
+    def message_count(self) -> int:
+        if self._messages is not None:
+            return len(self._messages)
+        return self.obj.get("message_count") or 0
+
+    @property
+    def message_tokens(self) -> int:
+        # headers written before it was kept load the messages once
+        if self._messages is None and "message_tokens" in self.obj:
+            return self.obj["message_tokens"]
+        return util.prompt_tokens(self.messages)
 
     @property
     def start_date(self):
@@ -802,7 +2507,7 @@ class Context(PropsMixin):
 
     @messages.setter
     def messages(self, value: List[PromptType | None]):
-        self.obj["messages"] = value
+        self._messages = value
         self.save()
 
     @smart_title.setter
@@ -817,21 +2522,532 @@ class Context(PropsMixin):
 
     def pop_user_prompt(self):
         try:
-            if self.obj["messages"][-2]["role"] != "user":
+            if self.messages[-2]["role"] != "user":
                 return None
-            self.obj["messages"].pop(-1)
-            u = self.obj["messages"].pop(-1)
+            self.messages.pop(-1)
+            u = self.messages.pop(-1)
             return u["content"]
         except:
             return None
 
 
+class RateLimit:
+    # token buckets fed by the x-ratelimit-* headers, in sqlite under the prompts dir
+    # so every hey process, terminal or script paces itself before sending
+    def __init__(self, filename: str):
+        self.filename = filename
+
+    @staticmethod
+    def New(prompts_dir: str = PROMPTS_DIR):
+        return RateLimit(os.path.join(prompts_dir, RATELIMIT_FILENAME))
+
+    def connect(self):
+        return util.sqlite(
+            self.filename,
+            [
+                "CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, lim REAL, "
+                "remaining REAL, reset_at REAL, window REAL)",
+                # interactive prompts waiting for room, batch jobs hold back for them
+                "CREATE TABLE IF NOT EXISTS waiters (id TEXT PRIMARY KEY, since REAL)",
+            ],
+        )
+
+    def acquire(self, tokens: int, batch: bool = False):
+        db = self.connect()
+        if db is None:
+            return
+        me = f"{os.getpid()}.{threading.get_ident()}"
+        start = time.perf_counter()
+        waited = False
+        try:
+            while True:
+                db.execute("BEGIN IMMEDIATE")
+                now = time.time()
+                wait = self.claim(db, now, tokens, batch)
+                if wait and not batch:
+                    db.execute(
+                        "INSERT OR REPLACE INTO waiters VALUES (?, ?)", (me, now)
+                    )
+                db.execute("COMMIT")
+                if not wait:
+                    break
+                if not waited and wait > 1:
+                    print(f"rate limited, waiting {wait:.0f}s", file=sys.stderr)
+                waited = True
+                time.sleep(min(wait, RATELIMIT_POLL))
+        finally:
+            if waited and not batch:
+                db.execute("DELETE FROM waiters WHERE id = ?", (me,))
+            db.close()
+        if waited:
+            Telemetry.record("ratelimit_wait", start, time.perf_counter())
+
+    def claim(self, db: Any, now: float, tokens: int, batch: bool):
+        # seconds to wait, or 0 once the request and its tokens are taken
+        if (
+            batch
+            and db.execute(
+                "SELECT 1 FROM waiters WHERE since > ?", (now - RATELIMIT_STALE,)
+            ).fetchone()
+        ):
+            return RATELIMIT_POLL
+        need = {"requests": 1, "tokens": tokens}
+        buckets: List[Tuple[str, float, float, float, float]] = []
+        wait = 0.0
+        for name, lim, remaining, reset_at, window in db.execute(
+            "SELECT * FROM buckets"
+        ):
+            if now >= reset_at:
+                # the window rolled over since the last answer told us where we stand
+                remaining, reset_at = lim, now + window
+            # batch jobs leave a slice of every window to interactive prompts
+            reserve = lim * RATELIMIT_RESERVE if batch else 0
+            if remaining - need[name] < reserve and need[name] <= lim:
+                wait = max(wait, reset_at - now)
+            buckets.append((name, lim, remaining - need[name], reset_at, window))
+        if wait:
+            return wait
+        db.executemany("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?)", buckets)
+        return 0
+
+    def observe(self, headers: Any, status: int = 200):
+        # requests, http.client and asyncio headers all answer .get(lowercase name)
+        now = time.time()
+        buckets: List[Tuple[str, float, float, float, float]] = []
+        for name in ("requests", "tokens"):
+            lim = headers.get(f"x-ratelimit-limit-{name}")
+            remaining = headers.get(f"x-ratelimit-remaining-{name}")
+            if lim is None or remaining is None:
+                continue
+            window = util.parse_duration(headers.get(f"x-ratelimit-reset-{name}") or "")
+            buckets.append((name, float(lim), float(remaining), now + window, window))
+        if status == 429 and not buckets:
+            retry = float(headers.get("retry-after") or 1)
+            buckets.append(("requests", 1.0, 0.0, now + retry, retry))
+        if not buckets:
+            return
+        db = self.connect()
+        if db is None:
+            return
+        try:
+            db.executemany(
+                "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?)", buckets
+            )
+        finally:
+            db.close()
+
+
+class BudgetError(Exception):
+    # over a --budget in block mode; retryable, so the prompt waits in the queue,
+    # but without the backoff, retrying cannot bring spend under the budget
+    retryable = True
+
+
+class Ledger:
+    # usage and cost of every request in sqlite, indexed by day, convo and model,
+    # with running totals per convo for budgets and --cost
+    current: "Ledger | None" = None
+    local = threading.local()
+
+    def __init__(
+        self,
+        filename: str,
+        budget: Dict[str, float] | None = None,
+        mode: str = "warn",
+    ):
+        self.filename = filename
+        self.budget = budget if budget is not None else {}
+        self.mode = mode
+
+    @staticmethod
+    def New(
+        prompts_dir: str = PROMPTS_DIR,
+        budget: Dict[str, float] | None = None,
+        mode: str = "warn",
+    ):
+        return Ledger(os.path.join(prompts_dir, USAGE_FILENAME), budget, mode)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def scope(convo: str):
+        # requests made inside are booked on this convo, per thread
+        outer = getattr(Ledger.local, "convo", "")
+        Ledger.local.convo = convo
+        try:
+            yield
+        finally:
+            Ledger.local.convo = outer
+
+    def connect(self):
+        return util.sqlite(
+            self.filename,
+            [
+                "CREATE TABLE IF NOT EXISTS usage (ts REAL, day TEXT, model TEXT, "
+                "convo TEXT, prompt INTEGER, completion INTEGER, cost REAL)",
+                "CREATE INDEX IF NOT EXISTS usage_day ON usage (day)",
+                "CREATE INDEX IF NOT EXISTS usage_convo ON usage (convo)",
+                "CREATE INDEX IF NOT EXISTS usage_model ON usage (model)",
+                # "*" is everything
+                "CREATE TABLE IF NOT EXISTS totals (scope TEXT PRIMARY KEY, requests "
+                "INTEGER, prompt INTEGER, completion INTEGER, cost REAL)",
+            ],
+        )
+
+    def record(self, model: str, prompt: int, completion: int, cost: float):
+        db = self.connect()
+        if db is None:
+            return
+        convo = getattr(Ledger.local, "convo", "")
+        try:
+            db.execute("BEGIN")
+            db.execute(
+                "INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), util.today(), model, convo, prompt, completion, cost),
+            )
+            db.executemany(
+                "INSERT INTO totals VALUES (?, 1, ?, ?, ?) ON CONFLICT (scope) DO "
+                "UPDATE SET "
+                "requests = requests + 1, prompt = prompt + excluded.prompt, "
+                "completion = completion + excluded.completion, cost = cost + "
+                "excluded.cost",
+                [(scope, prompt, completion, cost) for scope in {"*", convo}],
+            )
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    def spent(self, db: Any, scope: str, convo: str = "") -> float:
+        if scope == "convo":
+            row = db.execute(
+                "SELECT cost FROM totals WHERE scope = ?", (convo,)
+            ).fetchone()
+        else:
+            since = util.today()[: 7 if scope == "month" else 10]
+            row = db.execute(
+                "SELECT SUM(cost) FROM usage WHERE day >= ?", (since,)
+            ).fetchone()
+        return (row and row[0]) or 0.0
+
+    def check(self, model: str, messages: List[Any]):
+        # before sending: would this prompt go over a budget
+        if not self.budget:
+            return
+        db = self.connect()
+        if db is None:
+            return
+        convo = getattr(Ledger.local, "convo", "")
+        estimate = Telemetry.cost(model, util.prompt_tokens(messages), 0)
+        try:
+            for scope, limit in sorted(self.budget.items()):
+                if scope == "convo" and not convo:
+                    continue
+                spent = self.spent(db, scope, convo)
+                if spent + estimate <= limit:
+                    continue
+                message = (
+                    f"{scope} budget ${limit:.2f}: spent ${spent:.4f}, "
+                    f"this prompt ~${estimate:.4f}"
+                )
+                if self.mode == "block":
+                    raise BudgetError(message)
+                print("warning:", message, file=sys.stderr)
+        finally:
+            db.close()
+
+    def report(self, days: int = 30):
+        db = self.connect()
+        if db is None:
+            return print("no sqlite3, no cost report")
+        try:
+            total = db.execute("SELECT * FROM totals WHERE scope = '*'").fetchone()
+            if not total:
+                return print("no usage recorded yet")
+            _, requests, prompt, completion, cost = total
+            print(
+                f"total ${cost:.4f}, {requests} requests, {prompt} prompt + "
+                f"{completion} completion tokens"
+            )
+            for scope in ("day", "month"):
+                limit = self.budget.get(scope)
+                budget = f" of ${limit:.2f} ({self.mode})" if limit else ""
+                print(f"this {scope}: ${self.spent(db, scope):.4f}{budget}")
+            since = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+            print(f"\nlast {days} days\n")
+            print(f"{'model':<24}{'requests':>10}{'prompt':>12}", end="")
+            print(f"{'completion':>12}{'cost $':>10}")
+            for model, count, p_tok, c_tok, cost in db.execute(
+                "SELECT model, COUNT(*), SUM(prompt), SUM(completion), SUM(cost) FROM "
+                "usage "
+                "WHERE day >= ? GROUP BY model ORDER BY 5 DESC",
+                (since,),
+            ):
+                print(f"{model:<24}{count:>10}{p_tok:>12}{c_tok:>12}{cost:>10.4f}")
+            rows = db.execute(
+                "SELECT convo, COUNT(*), SUM(cost) FROM usage WHERE day >= ? "
+                "GROUP BY convo ORDER BY 3 DESC LIMIT ?",
+                (since, COST_TOP_CONVOS),
+            ).fetchall()
+            index = ConvoIndex.New(os.path.dirname(self.filename))
+            # deleted convos show their id
+            titles = {
+                c: t for c, t, f in index.titles([r[0] for r in rows if r[0]]) if f
+            }
+            print(f"\n{'convo':<48}{'requests':>10}{'cost $':>10}")
+            for convo, count, cost in rows:
+                title = (titles.get(convo) or convo or "-").replace("\n", " ")[:46]
+                print(f"{title:<48}{count:>10}{cost:>10.4f}")
+            print(f"\n{'day':<12}{'requests':>10}{'cost $':>10}")
+            for day, count, cost in db.execute(
+                "SELECT day, COUNT(*), SUM(cost) FROM usage WHERE day >= ? GROUP BY "
+                "day ORDER BY day",
+                (since,),
+            ):
+                print(f"{day:<12}{count:>10}{cost:>10.4f}")
+        finally:
+            db.close()
+
+
+class FetchError(Exception):
+    # an error answer from the api; 429 and 5xx are worth sending again later
+    def __init__(self, status: int, text: str):
+        super().__init__(f"error in fetch_prompt: {text}")
+        self.status = status
+
+    @property
+    def retryable(self):
+        return self.status == 429 or self.status >= 500
+
+
+class StdlibResponse:
+    # the slice of requests.Response that Fetch uses
+    def __init__(
+        self,
+        session: "StdlibSession",
+        key: Tuple[str, str],
+        conn: Any,
+        res: Any,
+        elapsed: float,
+    ):
+        self.session = session
+        self.key = key
+        self.conn: Any = conn
+        self.res = res
+        self.status_code = res.status
+        self.headers = res.headers
+        self.elapsed = timedelta(seconds=elapsed)
+        self.body: bytes | None = None
+
+    def iter_content(self):
+        gz = None
+        if self.res.getheader("Content-Encoding", "").lower() == "gzip":
+            gz = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # read1 hands over each chunk of a chunked stream as soon as it arrives
+        while chunk := self.res.read1(PIPE_CHUNK):
+            yield gz.decompress(chunk) if gz else chunk
+        if gz:
+            yield gz.flush()
+        # fully read (read1 alone never marks a HEAD response done)
+        self.res.close()
+        self.close()
+
+    def iter_lines(self):
+        rest = b""
+        for chunk in self.iter_content():
+            *lines, rest = (rest + chunk).split(b"\n")
+            for line in lines:
+                yield line.rstrip(b"\r")
+        if rest:
+            yield rest
+
+    @property
+    def content(self):
+        if self.body is None:
+            self.body = b"".join(self.iter_content())
+        return self.body
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", "replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def close(self):
+        if not self.conn:
+            return
+        # a fully read response leaves the connection ready for the next request
+        if self.res.isclosed() and not self.res.will_close:
+            self.session.release(self.key, self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+
+class StdlibSession:
+    # the slice of requests.Session that Fetch uses, on http.client with keep-alive
+    # and gzip
+    def __init__(self, timeout: float = REQUEST_DEADLINE):
+        self.timeout = timeout
+        self.idle: Dict[Tuple[str, str], List[Any]] = {}
+        self.lock = threading.Lock()
+
+    def connect(self, key: Tuple[str, str]):
+        import http.client
+        import ssl
+
+        with self.lock:
+            if self.idle.get(key):
+                return self.idle[key].pop(), True
+        scheme, netloc = key
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(
+                netloc, timeout=self.timeout, context=ssl.create_default_context()
+            )
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+        return conn, False
+
+    def release(self, key: Tuple[str, str], conn: Any):
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        headers: Dict[str, str] = {},
+        data: bytes | None = None,
+        stream: bool = False,
+        timeout: float | None = None,
+    ):
+        import http.client
+
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        headers = {**headers, "Accept-Encoding": "gzip"}
+        while True:
+            conn, reused = self.connect(key)
+            conn.timeout = timeout or self.timeout
+            if conn.sock:
+                conn.sock.settimeout(conn.timeout)
+            start = time.perf_counter()
+            try:
+                conn.request(method, path, data, headers)
+                res = conn.getresponse()
+                break
+            except (
+                http.client.RemoteDisconnected,
+                ConnectionResetError,
+                BrokenPipeError,
+            ):
+                conn.close()
+                # the server dropped an idle keep-alive connection, try the next one
+                if not reused:
+                    raise
+            except BaseException:
+                conn.close()
+                raise
+        response = StdlibResponse(self, key, conn, res, time.perf_counter() - start)
+        if not stream:
+            response.content
+        return response
+
+    def head(self, url: str, **kwargs: Any):
+        return self.request("HEAD", url, **kwargs)
+
+    def get(self, url: str, **kwargs: Any):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs: Any):
+        return self.request("POST", url, **kwargs)
+
+
+class StreamPrinter:
+    # openai sse lines -> stdout, shared by all transports
+    def __init__(self, model: str, pipe: bool = False):
+        self.model = model
+        self.pipe = pipe
+        self.text = ""
+        self.start = time.perf_counter()
+        self.first: float | None = None
+        self.usage: Dict[str, int] | None = None
+        self.done = False
+        # the reader of a pipe went away
+        self.gone = False
+        # annotate code blocks as they complete instead of after the stream
+        self.parser = (
+            util.codify_parser()
+            if util.codify and not pipe and not util.json_out
+            else None
+        )
+        # the answer also streams into HEY_OUT
+        self.sink = Sink.current if not pipe and not util.json_out else None
+
+    def feed(self, line: bytes):
+        # True once the reader is gone; after [DONE] the body is still read
+        # to its end, which leaves a keep-alive connection reusable
+        decoded_line = line.decode("utf-8")
+        if self.done or not decoded_line.startswith("data:"):
+            return False
+        event_data = decoded_line.replace("data:", "").strip()
+        if event_data == "[DONE]":
+            self.done = True
+            return False
+        data_json: StreamType = json.loads(event_data)
+        # the usage chunk comes last, with no choices
+        self.usage = data_json.get("usage") or self.usage
+        if not data_json["choices"]:
+            return False
+        message = data_json["choices"][0]["delta"].get("content", "")
+        if self.first is None:
+            self.first = time.perf_counter()
+            Telemetry.record("network_ttfb", self.start, self.first)
+            Telemetry.since("editor_exit", "editor_to_first_token")
+        self.text += message
+        if util.json_out:
+            util.emit({"type": "delta", "text": message})
+            return False
+        self.write(self.parser.feed(message) if self.parser else message)
+        return self.gone
+
+    def write(self, out: str):
+        if self.sink:
+            self.sink.write(out)
+        if self.gone:
+            return
+        try:
+            # a slow reader blocks the flush, which also holds back the download
+            sys.stdout.write(out)
+            sys.stdout.flush()
+        except BrokenPipeError:
+            util.silence_stdout()
+            self.gone = True
+
+    def close(self):
+        if self.parser:
+            self.write(self.parser.close())
+        end = time.perf_counter()
+        first = self.first or end
+        Telemetry.record("stream", first, end)
+        Telemetry.request(
+            self.model, self.usage, first - self.start, end - self.start, True
+        )
+        if not self.pipe and not util.json_out:
+            os.system("clear")
+        return self.text
+
+
 class Fetch:
     prompt_temp = 0.7
-    prompt_url = "https://api.openai.com/v1/chat/completions"
-    engine_url = "https://api.openai.com/v1/engines"
+    prompt_url = OPENAI_BASE_URL + "/chat/completions"
+    engine_url = OPENAI_BASE_URL + "/engines"
     max_tokens = MAX_TOKENS
     openaikey: str = OPENAIKEY
+    # set from the config in main, like util.codify
+    transport: str = DEFAULT_TRANSPORT
+    deadline: float = REQUEST_DEADLINE
+    limiter: "RateLimit | None" = None
 
     @staticmethod
     def New():
@@ -842,59 +3058,117 @@ class Fetch:
             "Content-Type": "application/json",
             "Authorization": "Bearer " + self.openaikey,
         }
+        self.pool: Any = None
+
+    @property
+    def session(self):
+        # one keep-alive pool for warm-up, answer and title requests
+        if self.pool is None:
+            if self.transport == "requests":
+                import requests
+
+                self.pool = requests.Session()
+            else:
+                self.pool = StdlibSession(self.deadline)
+        return self.pool
+
+    @property
+    def aio(self):
+        return AsyncFetch.New(self)
+
+    def warm(self):
+        if self.transport == "asyncio":
+            # every asyncio.run opens its own connections, only dns can be done ahead
+            return self.aio.warm()
+        # opens (tcp + tls) the connection the prompt will reuse, errors surface later
+        try:
+            self.session.head(self.engine_url, headers=self.headers, timeout=5)
+        except OSError:
+            pass
 
     def list_models(self):
-        res = requests.get(self.engine_url, headers=self.headers)
+        if self.transport == "asyncio":
+            return AsyncFetch.run(self.aio.list_models())
+        res = self.session.get(self.engine_url, headers=self.headers)
         return res.json()
 
     def models(self):
-        res = requests.get(self.engine_url, headers=self.headers)
-        return res.json()
+        return self.list_models()
 
     def smart_title(self, ledger: List[PromptType], max_char: int = 32):
         messages: List[PromptType] = ledger + [Prompt.title(max_char)]
         return self.prompt(messages, model="gpt-3.5-turbo")
 
+    def prompt_with_title(
+        self,
+        ledger: List[PromptType],
+        max_char: int,
+        messages: MixedPrompts,
+        model: str,
+        prompt_temp: float = prompt_temp,
+        stream: bool = False,
+        max_tokens: int = MAX_TOKENS,
+    ):
+        # the title only needs the question, the asyncio transport asks for both at once
+        if self.transport == "asyncio":
+            try:
+                self.budget(messages, model)
+            except BudgetError as error:
+                return (None, error), None
+            self.pace(messages, max_tokens)
+            self.pace(ledger, MAX_TOKENS)
+            return AsyncFetch.run(
+                self.aio.prompt_with_title(
+                    ledger, max_char, messages, model, prompt_temp, stream, max_tokens
+                )
+            )
+        return self.prompt(messages, model, prompt_temp, stream, max_tokens), None
+
+    def budget(self, messages: List[Any], model: str):
+        if Ledger.current:
+            Ledger.current.check(model, messages)
+
+    def pace(self, messages: List[Any], max_tokens: int, batch: bool = False):
+        if self.limiter:
+            self.limiter.acquire(util.estimate_tokens(messages, max_tokens), batch)
+
+    def observe(self, headers: Any, status: int):
+        if self.limiter:
+            self.limiter.observe(headers, status)
+
     def prompt_stream(
         self,
         messages: MixedPrompts,
         model: str,
         prompt_temp: float = prompt_temp,
         max_tokens: int = max_tokens,
+        pipe: bool = False,
     ):
         data = {
             "model": model,
             "messages": messages,
             "temperature": prompt_temp,
             "stream": True,
+            "stream_options": {"include_usage": True},
             "max_tokens": max_tokens,
         }
 
         try:
-            response = requests.post(
-                self.prompt_url, headers=self.headers, json=data, stream=True
+            printer = StreamPrinter(model, pipe)
+            response = self.session.post(
+                self.prompt_url,
+                headers=self.headers,
+                data=json.dumps(data).encode("utf-8"),
+                stream=True,
             )
+            self.observe(response.headers, response.status_code)
             if response.status_code != 200:
-                return (None, Exception(f"error in fetch_prompt: {response.text}"))
-            entire_response = ""
+                return (None, FetchError(response.status_code, response.text))
             for line in response.iter_lines():
-                if line:
-                    decoded_line = line.decode("utf-8")
-                    if decoded_line.startswith("data:"):
-                        event_data = decoded_line.replace("data:", "").strip()
-                        if event_data == "[DONE]":
-                            break
-                        else:
-                            data_json: StreamType = json.loads(event_data)
-                            message = data_json["choices"][0]["delta"].get(
-                                "content", ""
-                            )
-                            entire_response += message
-                            sys.stdout.write(message)
-                            sys.stdout.flush()
-
-            os.system("clear")
-            return (entire_response, None)
+                if line and printer.feed(line):
+                    break
+            response.close()
+            return (printer.close(), None)
 
         except json.JSONDecodeError as error:
             e = Exception(f"error parsing response in fetch_prompt: {error}")
@@ -911,10 +3185,21 @@ class Fetch:
         prompt_temp: float = prompt_temp,
         stream: bool = False,
         max_tokens: int = MAX_TOKENS,
+        pipe: bool = False,
+        batch: bool = False,
     ):
-        if stream:
+        try:
+            self.budget(messages, model)
+        except BudgetError as error:
+            return (None, error)
+        self.pace(messages, max_tokens, batch)
+        if self.transport == "asyncio":
+            return AsyncFetch.run(
+                self.aio.prompt(messages, model, prompt_temp, stream, max_tokens, pipe)
+            )
+        if stream or pipe:
             return self.prompt_stream(
-                messages, model, prompt_temp, max_tokens=max_tokens
+                messages, model, prompt_temp, max_tokens=max_tokens, pipe=pipe
             )
 
         text = ""
@@ -926,13 +3211,23 @@ class Fetch:
                 "temperature": prompt_temp or self.prompt_temp,
                 "max_tokens": max_tokens,
             }
-            res = requests.post(
+            start = time.perf_counter()
+            res = self.session.post(
                 self.prompt_url,
                 headers=self.headers,
-                json=data,
+                data=json.dumps(data).encode("utf-8"),
             )
+            end = time.perf_counter()
+            self.observe(res.headers, res.status_code)
+            if res.status_code != 200:
+                return (res.text, FetchError(res.status_code, res.text))
+            Telemetry.since("editor_exit", "editor_to_first_token")
+            Telemetry.record("network_ttfb", start, start + res.elapsed.total_seconds())
             text = res.text
             json_data = res.json()
+            Telemetry.request(
+                model, json_data.get("usage"), res.elapsed.total_seconds(), end - start
+            )
             # print(json_data)
             return (json_data["choices"][0]["message"]["content"], None)
         except KeyError:
@@ -945,6 +3240,259 @@ class Fetch:
             return (text, error)
 
 
+class AsyncHTTP:
+    # just enough http/1.1 on asyncio streams for the openai api, a connection
+    # per request
+    def __init__(
+        self,
+        reader: Any,
+        writer: Any,
+        status: int,
+        headers: Dict[str, str],
+    ):
+        self.reader = reader
+        self.writer = writer
+        self.status = status
+        self.headers = headers
+
+    @staticmethod
+    async def New(
+        method: str, url: str, headers: Dict[str, str], body: bytes | None = None
+    ):
+        import asyncio
+        import ssl
+
+        parts = urllib.parse.urlsplit(url)
+        https = parts.scheme == "https"
+        reader, writer = await asyncio.open_connection(
+            parts.hostname,
+            parts.port or (443 if https else 80),
+            ssl=ssl.create_default_context() if https else None,
+        )
+        try:
+            path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+            head = [
+                f"{method} {path} HTTP/1.1",
+                f"Host: {parts.netloc}",
+                "Connection: close",
+                "Accept-Encoding: identity",
+                *(f"{k}: {v}" for k, v in headers.items()),
+            ]
+            if body is not None:
+                head.append(f"Content-Length: {len(body)}")
+            writer.write(
+                ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + (body or b"")
+            )
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            res_headers: Dict[str, str] = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                k, _, v = line.decode("latin-1").partition(":")
+                res_headers[k.strip().lower()] = v.strip()
+        except BaseException:
+            writer.close()
+            raise
+        return AsyncHTTP(reader, writer, status, res_headers)
+
+    async def chunks(self):
+        if self.headers.get("transfer-encoding", "").lower() == "chunked":
+            while size := int((await self.reader.readline()).split(b";")[0], 16):
+                yield await self.reader.readexactly(size)
+                await self.reader.readexactly(2)
+        elif "content-length" in self.headers:
+            yield await self.reader.readexactly(int(self.headers["content-length"]))
+        else:
+            while chunk := await self.reader.read(PIPE_CHUNK):
+                yield chunk
+
+    async def read(self):
+        return b"".join([chunk async for chunk in self.chunks()])
+
+    async def lines(self):
+        rest = b""
+        async for chunk in self.chunks():
+            *lines, rest = (rest + chunk).split(b"\n")
+            for line in lines:
+                yield line.rstrip(b"\r")
+        if rest:
+            yield rest
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncFetch:
+    # the asyncio transport, Fetch is its sync facade for the cli
+    def __init__(self, fetch: Fetch):
+        self.fetch = fetch
+
+    @staticmethod
+    def New(fetch: Fetch):
+        return AsyncFetch(fetch)
+
+    @staticmethod
+    def run(coro: Any):
+        # asyncio is only imported by runs that use this transport
+        import asyncio
+
+        return asyncio.run(coro)
+
+    async def request(self, method: str, url: str, data: Any = None):
+        body = json.dumps(data).encode("utf-8") if data is not None else None
+        return await AsyncHTTP.New(method, url, self.fetch.headers, body)
+
+    def warm(self):
+        import socket
+
+        parts = urllib.parse.urlsplit(self.fetch.engine_url)
+        with contextlib.suppress(OSError):
+            socket.getaddrinfo(parts.hostname, parts.port or 443)
+
+    async def list_models(self):
+        import asyncio
+
+        async with asyncio.timeout(self.fetch.deadline):
+            res = await self.request("GET", self.fetch.engine_url)
+            try:
+                return json.loads(await res.read())
+            finally:
+                res.close()
+
+    async def smart_title(self, ledger: List[PromptType], max_char: int = 32):
+        messages: List[PromptType] = ledger + [Prompt.title(max_char)]
+        return await self.prompt(messages, model="gpt-3.5-turbo")
+
+    async def prompt_with_title(
+        self,
+        ledger: List[PromptType],
+        max_char: int,
+        messages: MixedPrompts,
+        model: str,
+        prompt_temp: float = Fetch.prompt_temp,
+        stream: bool = False,
+        max_tokens: int = MAX_TOKENS,
+    ):
+        import asyncio
+
+        tasks = [
+            asyncio.ensure_future(
+                self.prompt(messages, model, prompt_temp, stream, max_tokens)
+            ),
+            asyncio.ensure_future(self.smart_title(ledger, max_char)),
+        ]
+        try:
+            await asyncio.wait(tasks)
+        except asyncio.CancelledError:
+            # ctrl-c: both requests wind down and report what they got
+            for task in tasks:
+                task.cancel()
+            await asyncio.wait(tasks)
+        return tasks[0].result(), tasks[1].result()
+
+    async def prompt_stream(
+        self,
+        messages: MixedPrompts,
+        model: str,
+        prompt_temp: float = Fetch.prompt_temp,
+        max_tokens: int = MAX_TOKENS,
+        pipe: bool = False,
+    ):
+        import asyncio
+
+        data = {
+            "model": model,
+            "messages": messages,
+            "temperature": prompt_temp,
+            "stream": True,
+            "stream_options": {"include_usage": True},
+            "max_tokens": max_tokens,
+        }
+        printer = StreamPrinter(model, pipe)
+        res: AsyncHTTP | None = None
+        try:
+            async with asyncio.timeout(self.fetch.deadline):
+                res = await self.request("POST", self.fetch.prompt_url, data)
+                self.fetch.observe(res.headers, res.status)
+                if res.status != 200:
+                    text = (await res.read()).decode("utf-8", "replace")
+                    return (None, FetchError(res.status, text))
+                async for line in res.lines():
+                    if line and printer.feed(line):
+                        break
+            return (printer.close(), None)
+        except asyncio.CancelledError:
+            # ctrl-c stops the stream, what already arrived is the answer
+            if printer.first is None:
+                return (None, Exception("cancelled"))
+            return (printer.close(), None)
+        except TimeoutError:
+            return (None, TimeoutError(f"no answer within {self.fetch.deadline}s"))
+        except json.JSONDecodeError as error:
+            e = Exception(f"error parsing response in fetch_prompt: {error}")
+            return (None, e)
+        except Exception as error:
+            return (None, error)
+        finally:
+            if res:
+                res.close()
+
+    async def prompt(
+        self,
+        messages: MixedPrompts,
+        model: str,
+        prompt_temp: float = Fetch.prompt_temp,
+        stream: bool = False,
+        max_tokens: int = MAX_TOKENS,
+        pipe: bool = False,
+    ):
+        import asyncio
+
+        if stream or pipe:
+            return await self.prompt_stream(
+                messages, model, prompt_temp, max_tokens=max_tokens, pipe=pipe
+            )
+
+        text = ""
+        json_data: Any = {}
+        res: AsyncHTTP | None = None
+        try:
+            data = {
+                "model": model,
+                "messages": messages,
+                "temperature": prompt_temp or self.fetch.prompt_temp,
+                "max_tokens": max_tokens,
+            }
+            async with asyncio.timeout(self.fetch.deadline):
+                start = time.perf_counter()
+                res = await self.request("POST", self.fetch.prompt_url, data)
+                ttfb = time.perf_counter()
+                text = (await res.read()).decode("utf-8")
+                self.fetch.observe(res.headers, res.status)
+                if res.status != 200:
+                    return (text, FetchError(res.status, text))
+            end = time.perf_counter()
+            Telemetry.since("editor_exit", "editor_to_first_token")
+            Telemetry.record("network_ttfb", start, ttfb)
+            json_data = json.loads(text)
+            Telemetry.request(model, json_data.get("usage"), ttfb - start, end - start)
+            return (json_data["choices"][0]["message"]["content"], None)
+        except asyncio.CancelledError:
+            return (None, Exception("cancelled"))
+        except TimeoutError:
+            return (text, TimeoutError(f"no answer within {self.fetch.deadline}s"))
+        except KeyError:
+            e = Exception(f"unrecognized response in fetch_prompt: {text}")
+            return (json_data, e)
+        except json.JSONDecodeError as error:
+            e = Exception(f"error parsing response in fetch_prompt: {error}")
+            return (text, e)
+        except Exception as error:
+            return (text, error)
+        finally:
+            if res:
+                res.close()
+
+
 class Client:
     def __init__(
         self,
@@ -955,10 +3503,13 @@ class Client:
         self.fetcher = fetcher
         self.config = config
         self.context = context
+        # a title fetched alongside the answer, used up by conjure_smart_title
+        self.early_title: Tuple[Any, Any] | None = None
         self.gentle_install()
         self.read_all()
 
     @staticmethod
+    @Telemetry.timed("client_new")
     def New(
         fetcher: Fetch = Fetch.New(),
         config: Config = Config.New(),
@@ -972,19 +3523,11 @@ class Client:
         # print(f"Deleting convo {convo_id} {convo_title} {md_file}")
         ans = input(f"Delete convo: {convo_title}? (y/n) ")
         if ans.lower() == "y":
-            os.remove(util.ctx_path(self.config.prompts_dir, convo_id))
+            Context.New(convo=convo_id, prompts_dir=self.config.prompts_dir).remove()
             os.remove(md_file)
 
-    def tidy_contexts(self):
-        for ctx_file in self.config.list_context_files():
-            try:
-                ctx = json.load(open(ctx_file))
-                if ctx.get("smart_title"):
-                    continue
-            except:
-                pass
-            os.remove(ctx_file)
-            print(f"Removing {ctx_file}")
+    def tidy_contexts(self, dry_run: bool = False):
+        return Maintenance.New(self, dry_run=dry_run).tidy()
 
     def set_system(self, system_sentence: str):
         self.context.system = system_sentence
@@ -1005,61 +3548,114 @@ class Client:
     def pins(self):
         return self.config.pins
 
-    def archive(self):
-        archive_dir = os.path.join(self.config.prompts_dir, "archive")
-
-        if not os.path.exists(archive_dir):
-            os.makedirs(archive_dir)
-
-        for f in self.config.list_context_files():
-            fbasename = os.path.basename(f)
-            archive_fpath = os.path.join(archive_dir, fbasename)
-            # get id from hey_context basename
-            id = fbasename.split(".")[2]
-            # if id is in self.pins
-            if id in self.config.pins:
-                print(f"{f} is pinned, skipping")
-                continue
-            print(f"archiving {fbasename}")
-            os.rename(f, archive_fpath)
-        return
+    def archive(self, dry_run: bool = False):
+        return Maintenance.New(self, dry_run=dry_run).archive()
 
     def info(self):
-        print("prompts dir:", self.config.prompts_dir)
-        print("config file:", self.config.filename)
-        print("context file:", self.context.filename)
-        print("editor:", self.config.editor)
-        print("model:", self.config.model)
-        print("md_file:", self.context.md_file)
-        print("temp:", self.config.temp / 10)
-        print("max_tokens:", self.config.max_tokens)
-        print("convo:", self.config.convo)
-        print("detail:", self.config.detail)
+        info: Dict[str, Any] = {
+            "prompts dir": self.config.prompts_dir,
+            "config file": self.config.filename,
+            "context file": self.context.filename,
+            "editor": self.config.editor,
+            "model": self.config.model,
+            "md_file": self.context.md_file,
+            "temp": self.config.temp / 10,
+            "max_tokens": self.config.max_tokens,
+            "convo": self.config.convo,
+            "detail": self.config.detail,
+            "transport": self.config.transport,
+        }
         if self.context.smart_title:
-            print("smart_title:", self.context.smart_title)
-        print("messages:", len(self.context.messages))
-        print("system:", self.context.system)
+            info["smart_title"] = self.context.smart_title
+        for link in ("parent", "child"):
+            if self.context.obj.get(link):
+                info[link] = self.context.obj[link]
+        info["messages"] = self.context.message_count
+        info["system"] = self.context.system
+        # what the next turn sends as it stands, before the new prompt
+        tokens = (
+            util.prompt_tokens([Prompt.system(self.context.system)])
+            + self.context.message_tokens
+        )
+        cost = Telemetry.cost(self.config.model, tokens, 0)
+        if util.json_out:
+            info = {k.replace(" ", "_"): v for k, v in info.items()}
+            return util.emit(
+                {
+                    "type": "info",
+                    **info,
+                    "next_prompt_tokens": tokens,
+                    "next_prompt_cost": cost,
+                    "budget": self.config.budget,
+                    "budget_mode": self.config.budget_mode,
+                }
+            )
+        for key, value in info.items():
+            print(f"{key}:", value)
+        print(f"next prompt: ~{tokens} tokens, ~${cost:.4f}")
+        if self.config.budget:
+            print("budget:", self.config.budget, self.config.budget_mode)
+
+    def emit_answer(
+        self, prompt: str, ai_prompt: PromptType, model: str = "", saved: bool = True
+    ):
+        # --json: the answer with what every request of this run used, title included
+        requests = Telemetry.requests
+        util.emit(
+            {
+                "type": "answer",
+                "convo": self.convo if saved else None,
+                "title": self.context.smart_title if saved else None,
+                "md_file": self.context.md_file if saved else None,
+                "model": model or self.model,
+                "prompt": prompt,
+                "answer": ai_prompt["content"],
+                "usage": {
+                    "prompt_tokens": sum(r["prompt_tokens"] for r in requests),
+                    "completion_tokens": sum(r["completion_tokens"] for r in requests),
+                },
+                "cost": sum(r["cost"] for r in requests),
+                "requests": requests,
+            }
+        )
 
     def get_convos(self):
         return self.config.list_convos()
 
     def convos_with_titles(self):
-        return self.add_titles_to_convos(self.config.list_convos())
+        index = ConvoIndex.New(self.config.prompts_dir)
+        return index.titles(self.config.list_convos(), complete=True)
 
     def add_titles_to_convos(self, convos: List[str]):
-        convos = convos
-        convos_with_titles: List[Tuple[str, str, str]] = []
-        for _, b in enumerate(convos):
-            b_path = util.ctx_path(self.config.prompts_dir, b)
-            title: str = "unknown"
-            mdfile: str = ""
-            if os.path.exists(b_path):
-                with open(b_path, "r") as f:
-                    j = json.load(f)
-                    title = j["smart_title"]
-                    mdfile = j["md_file"]
-            convos_with_titles.append((b, title, mdfile))
-        return convos_with_titles
+        return ConvoIndex.New(self.config.prompts_dir).titles(convos)
+
+    def chain(self):
+        # parent links back to the first part, then child links forward
+        prompts_dir = self.config.prompts_dir
+        convos = [self.convo]
+        seen = set(convos)
+
+        def link(convo: str, key: str):
+            try:
+                obj = FileCache.load(util.ctx_path(prompts_dir, convo), json.loads)
+            except FileNotFoundError:
+                return None
+            nxt = obj.get(key)
+            return None if nxt in seen else nxt
+
+        while parent := link(convos[0], "parent"):
+            convos.insert(0, parent)
+            seen.add(parent)
+        while child := link(convos[-1], "child"):
+            convos.append(child)
+            seen.add(child)
+        return convos
+
+    def print_chain(self):
+        self.print_convoe_title_enumeration(
+            convos_with_titles=self.add_titles_to_convos(self.chain()),
+            with_filename=True,
+        )
 
     def print_pins_with_titles(self):
         if not self.config.pins:
@@ -1085,6 +3681,18 @@ class Client:
         with_filename: bool = False,
     ):
         for i, (b, title, filename) in enumerate(convos_with_titles):
+            if util.json_out:
+                util.emit(
+                    {
+                        "type": "convo",
+                        "index": i,
+                        "convo": b,
+                        "title": title,
+                        "md_file": filename,
+                        "current": self.convo == b,
+                    }
+                )
+                continue
             f = f" @{filename}" if with_filename else ""
             if not title:
                 title = "<BLANK>"
@@ -1095,6 +3703,7 @@ class Client:
                 # not printing convo id
                 print(f"\033[1m{i}: {title}\033[0m")
 
+    @Telemetry.timed("add_prompts")
     def add_prompts(self, user_prompt: PromptType, ai_prompt: PromptType):
         self.add_prompt(user_prompt)
         self.add_prompt(ai_prompt)
@@ -1105,8 +3714,7 @@ class Client:
         if not self.context.start_date:
             self.context.start_date = datetime.now().isoformat()
         # if not os.path.exists(self.context.md_file):
-        self.write_header()
-        self.write_conversation()
+        self.write_md()
 
     # conveniece method for adding a single prompt to the context
     def fetch_prompt_with_context(
@@ -1117,34 +3725,116 @@ class Client:
         model: str = "",
         stream: bool = False,
         imgs: List[str] = [],
+        warm: "concurrent.futures.Future[Any] | None" = None,
+    ):
+        ctx = self.build_prompt(prompt, system, trim, imgs, warm)
+        title = None
+        if not self.context.messages or not self.context.smart_title:
+            title = [Prompt.user(prompt)]
+        return self.fetch_prompt(
+            ctx, model=(model or self.model), stream=stream, title=title
+        )
+
+    def queue_prompt(
+        self,
+        prompt: str,
+        system: str,
+        trim: int = 0,
+        model: str = "",
+        imgs: List[str] = [],
+        warm: "concurrent.futures.Future[Any] | None" = None,
+        error: str | None = None,
+    ):
+        ctx = self.build_prompt(prompt, system, trim, imgs, warm)
+        return Spool.New(self).put(
+            self.convo, prompt, ctx, model or self.model, error=error
+        )
+
+    def build_prompt(
+        self,
+        prompt: str,
+        system: str,
+        trim: int = 0,
+        imgs: List[str] = [],
+        warm: "concurrent.futures.Future[Any] | None" = None,
     ):
+        prefix, built = warm.result() if warm else (None, None)
         user_prompt = (
             Prompt.user(prompt)
             if not imgs
-            else Prompt.user_with_imgs(prompt, imgs, detail=self.config.detail)
+            else Prompt.user_with_imgs(
+                prompt, imgs, detail=self.config.detail, built=built
+            )
         )
 
-        ctx = ([Prompt.system(system)] + self.context.messages + [user_prompt])[trim:]
-        return self.fetch_prompt(ctx, model=(model or self.model), stream=stream)
-
+        with Telemetry.span("request_build"):
+            if prefix is None:
+                prefix = [Prompt.system(system)] + self.context.messages
+            ctx = (prefix + [user_prompt])[trim:]
+        return ctx
+
+    def prewarm(self, system: str, imgs: List[str] = []):
+        # runs while the editor is open, so :wq only waits for the model
+        def warm():
+            start = time.perf_counter()
+            self.fetcher.warm()
+            prefix = [Prompt.system(system)] + self.context.messages
+            built = [util.img_up_build(img, self.config.detail) for img in imgs]
+            Telemetry.record("prewarm", start, time.perf_counter())
+            return prefix, built
+
+        pool = concurrent.futures.ThreadPoolExecutor(1)
+        future = pool.submit(warm)
+        pool.shutdown(wait=False)
+        return future
+
+    @Telemetry.timed("fetch_prompt")
     def fetch_prompt(
         self,
         messages: List[PromptType | ImgPromptType],
         model: str = "",
         stream: bool = False,
+        pipe: bool = False,
+        title: List[PromptType] | None = None,
     ):
-        response, error = self.fetcher.prompt(
-            messages,
-            model or self.model,
-            self.config.temp / 10,
-            stream=stream,
-            max_tokens=self.config.max_tokens,
-        )
+        with Ledger.scope("" if pipe else self.context.convo):
+            return self._fetch_prompt(messages, model, stream, pipe, title)
+
+    def _fetch_prompt(
+        self,
+        messages: List[PromptType | ImgPromptType],
+        model: str,
+        stream: bool,
+        pipe: bool,
+        title: List[PromptType] | None,
+    ):
+        if title is not None:
+            (response, error), self.early_title = self.fetcher.prompt_with_title(
+                title,
+                64,
+                messages,
+                model or self.model,
+                self.config.temp / 10,
+                stream=stream,
+                max_tokens=self.config.max_tokens,
+            )
+        else:
+            response, error = self.fetcher.prompt(
+                messages,
+                model or self.model,
+                self.config.temp / 10,
+                stream=stream,
+                max_tokens=self.config.max_tokens,
+                pipe=pipe,
+            )
 
         # print(response, error)
         if error:
-            print("error fetch_prompt=" + str(error))
-            raise Exception(str(error) + "\n" + str(response))
+            print(
+                "error fetch_prompt=" + str(error),
+                file=sys.stderr if pipe else sys.stdout,
+            )
+            raise Exception(str(error) + "\n" + str(response)) from error
         return Prompt.ai(str(response))
 
     def reset(self, silent: bool = False):
@@ -1195,20 +3885,101 @@ class Client:
         return self.new_context(convo)
 
     def new_context(self, convo: str = util.uuid()):
-        self.config.convo = convo
-        self.context = Context.New(convo=self.config.convo)
+        self.context = Context.New(convo=convo, prompts_dir=self.config.prompts_dir)
         self.context.save()
-        self.config.context_filename = self.context.filename
-        self.config.save()
+        self.config.convo = convo
 
-    def most_recent_convo(self, force_recent: bool = True):
+    def rollover_reason(self):
+        limits = self.config.rollover
+        ctx = self.context
+        if ctx.message_count <= ROLLOVER_TAIL:
+            return None
+        if limits.get("messages") and ctx.message_count >= limits["messages"]:
+            return f"{ctx.message_count} messages"
+        if limits.get("bytes"):
+            try:
+                size = os.path.getsize(ctx.chunks_filename)
+            except OSError:
+                size = 0
+            if size >= limits["bytes"]:
+                return f"{size} bytes"
+        if limits.get("tokens"):
+            tokens = ctx.message_tokens
+            if tokens >= limits["tokens"]:
+                return f"~{tokens} tokens"
+        return None
+
+    def rollover_carry(self) -> List[Any]:
+        messages = self.context.messages
+        if self.config.rollover_carry == "summary":
+            with Ledger.scope(self.context.convo):
+                summary, error = self.fetcher.prompt(
+                    [
+                        self.context.system_prompt,
+                        *messages,
+                        Prompt.user(ROLLOVER_SUMMARY),
+                    ],
+                    self.model,
+                    self.config.temp / 10,
+                    max_tokens=self.config.max_tokens,
+                )
+            if not error:
+                return [
+                    Prompt.system("Earlier in this conversation:\n\n" + str(summary))
+                ]
+            print(f"summary failed, carrying the last messages instead: {error}")
+        tail = messages[-ROLLOVER_TAIL:]
+        # start on a question
+        while tail and tail[0]["role"] != "user":
+            tail = tail[1:]
+        return tail
+
+    def rollover(self):
+        # a convo past the size limits continues in a linked child that starts from
+        # the tail (or a summary) of this one, so a turn never re-sends all of it
+        reason = self.rollover_reason()
+        if not reason:
+            return None
+        parent = self.context
+        carry = self.rollover_carry()
+        part = (parent.obj.get("part") or 1) + 1
+        lineage = parent.obj.get("lineage") or parent.smart_title or ""
+        self.new_context(util.uuid())
+        child = self.context
+        child.obj.update(
+            {
+                "parent": parent.convo,
+                "part": part,
+                "lineage": lineage,
+                "system": parent.system,
+            }
+        )
+        if lineage:
+            child.obj["smart_title"] = f"{lineage} (part {part})"
+            child.smart_title_slug = child.obj["smart_title"]
+        child.messages = carry
+        parent.obj["child"] = child.convo
+        parent.save()
+        print(f"convo reached {reason}, continuing in part {part}")
+        return child
+
+    def most_recent_md_file(self, force_recent: bool = True):
         f: str | None = self.context.md_file
         if force_recent and (not f or not os.path.exists(f)):
             f = util.recent_file(self.config.prompts_dir, "md")
+        return f
+
+    def most_recent_convo(self, force_recent: bool = True):
+        f = self.most_recent_md_file(force_recent)
         if f:
             with open(f, "r") as md_file:
                 return md_file.read()
 
+    def most_recent_window(self, window: slice):
+        f = self.most_recent_md_file()
+        if f:
+            yield from util.md_window(f, self.context.md_turns(f), window)
+
     def mk_prompt_path(self, slug: str):
         if not os.path.exists(os.path.join(self.config.prompts_dir, slug + ".md")):
             return os.path.join(self.config.prompts_dir, slug + ".md")
@@ -1221,23 +3992,46 @@ class Client:
                 return filename
             id += 1
 
-    def write_header(self):
-        if (
-            self.context.md_file
-            and self.context.smart_title
-            and self.context.start_date
-        ):
-            with open(self.context.md_file, "w+") as f:
-                f.write(util.title_block(self.context.smart_title))
-                f.write(util.date_block(self.context.start_date))
-
-    def write_conversation(self):
-        if self.context.md_file and self.context.messages:
-            with open(self.context.md_file, "a+") as f:
-                for message in self.context.messages:
-                    f.write(util.msg_block(message))
-        else:
+    @Telemetry.timed("md_write")
+    def write_md(self):
+        if not self.context.md_file or not self.context.messages:
             raise Exception("no context.md_file or context.messages")
+        text, turns, size = self.md_text(self.context.messages)
+        util.atomic_write(self.context.md_file, text)
+        self.context.set_md_index(turns, size)
+
+    def md_text(self, messages: List[Any]):
+        header = self.md_header()
+        blocks: List[str] = []
+        turns: List[int] = []
+        offset = len(header.encode("utf-8"))
+        for message in messages:
+            block = util.msg_block(message)
+            if message["role"] == "user":
+                # msg_block starts with a newline, the index points at "### User"
+                turns.append(offset + 1)
+            offset += len(block.encode("utf-8"))
+            blocks.append(block)
+        return header + "".join(blocks), turns, offset
+
+    def md_header(self):
+        if self.context.smart_title and self.context.start_date:
+            return (
+                util.title_block(self.context.smart_title)
+                + util.date_block(self.context.start_date)
+                + self.md_parent()
+            )
+        return ""
+
+    def md_parent(self):
+        parent = self.context.obj.get("parent")
+        if not parent:
+            return ""
+        _, title, md_file = ConvoIndex.New(self.config.prompts_dir).titles([parent])[0]
+        if not md_file:
+            # deleted or archived, no link to follow
+            return f"\n_continued from convo {parent}_\n"
+        return f"\n_continued from [{title}]({md_file})_\n"
 
     def add_prompt(self, message: PromptType | ImgPromptType):
         self.context.messages.copy()
@@ -1249,6 +4043,7 @@ class Client:
         self.context.gentle_save()
         self.config.gentle_save()
 
+    @Telemetry.timed("read_all")
     def read_all(self):
         self.context.open()
         self.config.open()
@@ -1266,6 +4061,7 @@ class Client:
 
         return self.context.smart_title_slug or ""
 
+    @Telemetry.timed("title_fetch")
     def conjure_smart_title(self, max_length: int = 32):
         msgs = self.context.messages
         fallbackname = (
@@ -1273,7 +4069,9 @@ class Client:
             if len(msgs) > 0
             else datetime.now().strftime("%Y-%m-%d")
         )
-        (title, error) = self.fetcher.smart_title(msgs, max_length)
+        early, self.early_title = self.early_title, None
+        with Ledger.scope(self.context.convo):
+            (title, error) = early or self.fetcher.smart_title(msgs, max_length)
         if error:
             print(error)
             return fallbackname
@@ -1282,6 +4080,640 @@ class Client:
             return str(title)
 
 
+class Maintenance:
+    # --archive and --tidy over every context file, file work runs on a thread pool
+    def __init__(
+        self,
+        client: Client,
+        dry_run: bool = False,
+        workers: int = MAINTENANCE_WORKERS,
+    ):
+        self.client = client
+        self.config = client.config
+        self.dry_run = dry_run
+        self.workers = workers
+        self.counts: Dict[str, int] = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def New(client: Client, dry_run: bool = False):
+        return Maintenance(client, dry_run=dry_run)
+
+    def count(self, what: str, paths: List[str]):
+        size = sum(os.path.getsize(p) for p in paths)
+        with self.lock:
+            self.counts[what] = self.counts.get(what, 0) + 1
+            self.bytes += size
+
+    def pool_map(self, fn: Callable[[Any], Any], items: List[Any]) -> List[Any]:
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            return list(pool.map(fn, items))
+
+    def context(self, convo: str):
+        return Context.New(convo=convo, prompts_dir=self.config.prompts_dir)
+
+    def tidy(self):
+        def check(ctx_file: str):
+            try:
+                with open(ctx_file, "rb") as f:
+                    if json.loads(f.read()).get("smart_title"):
+                        return None
+            except (OSError, ValueError):
+                pass
+            ctx = self.context(util.convo_from_path(ctx_file))
+            self.count("contexts", ctx.files())
+            if not self.dry_run:
+                ctx.remove()
+            return ctx_file
+
+        verb = "Would remove" if self.dry_run else "Removing"
+        for ctx_file in self.pool_map(
+            check, self.config.list_context_files(sort=False)
+        ):
+            if ctx_file:
+                print(f"{verb} {ctx_file}")
+        snippets = SnippetStore.New().gc(dry_run=self.dry_run)
+        results = MapReduce.New(self.client).gc(dry_run=self.dry_run)
+        blobs = self.gc_blobs()
+        if self.dry_run:
+            return print(
+                f"dry run: {self.counts.get('contexts', 0)} untitled contexts "
+                f"({self.bytes:,} bytes), {snippets} codify snippets, "
+                f"{results} map_reduce results and {blobs} blobs would be removed"
+            )
+        if snippets:
+            print(f"Removed {snippets} old codify snippets")
+        if results:
+            print(f"Removed {results} old map_reduce results")
+        if blobs:
+            print(f"Removed {blobs} unreferenced blobs")
+
+    def gc_blobs(self):
+        def referenced(ctx_file: str) -> List[str] | None:
+            # from what is on disk now: the nodes of the chunk log (every branch) and
+            # the current system prompt, a replaced one is garbage
+            try:
+                header = FileCache.load(ctx_file, json.loads)
+            except FileNotFoundError:
+                return []
+            except ValueError:
+                return None
+            # read past FileCache, which may hold the unpacked nodes
+            chunks = os.path.splitext(ctx_file)[0] + ".chunks"
+            try:
+                with open(chunks, "rb") as f:
+                    nodes = ChunkLog.parse(f.read())
+            except FileNotFoundError:
+                nodes = []
+            except Exception:
+                return None
+            blobs = [m["blob"] for m in nodes if "blob" in m]
+            if header.get("system_blob"):
+                blobs.append(header["system_blob"])
+            return blobs
+
+        # in a dry run the untitled contexts stay, their blobs count as referenced
+        live: set[str] = set()
+        for blobs in self.pool_map(
+            referenced, self.config.list_context_files(sort=False)
+        ):
+            if blobs is None:
+                print("unreadable context or chunk log, skipping blob gc")
+                return 0
+            live.update(blobs)
+        return BlobStore.New(self.config.prompts_dir).gc(live, dry_run=self.dry_run)
+
+    @staticmethod
+    def shard(obj: Dict[str, Any]) -> str:
+        date = obj.get("end_date") or obj.get("start_date") or ""
+        return date[:7] or "undated"
+
+    def archive(self):
+        archive_dir = os.path.join(self.config.prompts_dir, "archive")
+        convos: List[str] = []
+        for ctx_file in self.config.list_context_files(sort=False):
+            convo = util.convo_from_path(ctx_file)
+            if convo in self.config.pins:
+                print(f"{ctx_file} is pinned, skipping")
+                continue
+            convos.append(convo)
+
+        def load(convo: str):
+            ctx = self.context(convo)
+            ctx.open()
+            return ctx, ctx.to_dict()
+
+        shards: Dict[str, List[Tuple[Context, Dict[str, Any]]]] = {}
+        for ctx, obj in self.pool_map(load, convos):
+            shards.setdefault(Maintenance.shard(obj), []).append((ctx, obj))
+        stamp = datetime.now().strftime("%Y%m%d%H%M%S")
+
+        def pack(shard: str):
+            shard_dir = os.path.join(archive_dir, shard)
+            packed: List[Tuple[str, Dict[str, Any]]] = []
+            moves: List[Tuple[str, str]] = []
+            for ctx, obj in shards[shard]:
+                convo = util.convo_from_path(ctx.filename)
+                paths = ctx.files()
+                md_file = obj.get("md_file")
+                if md_file and os.path.exists(md_file):
+                    paths.append(md_file)
+                    target = os.path.join(shard_dir, os.path.basename(md_file))
+                    if os.path.exists(target):
+                        target = os.path.join(
+                            shard_dir, convo + "." + os.path.basename(md_file)
+                        )
+                    moves.append((md_file, target))
+                    obj = {**obj, "md_file": target}
+                    self.count("md_files", [])
+                self.count("contexts", paths)
+                packed.append((convo, obj))
+            if self.dry_run:
+                return
+            os.makedirs(shard_dir, exist_ok=True)
+            ContextPack(os.path.join(shard_dir, f"contexts.{stamp}.heypack")).write(
+                packed
+            )
+            # md files go next to the pack, prompts.html stops picking them up
+            for md_file, target in moves:
+                os.replace(md_file, target)
+            for ctx, _ in shards[shard]:
+                ctx.remove()
+            print(f"archived {len(packed)} contexts into {shard_dir}")
+
+        self.pool_map(pack, sorted(shards))
+        if self.dry_run:
+            print(
+                f"dry run: {self.counts.get('contexts', 0)} contexts and "
+                f"{self.counts.get('md_files', 0)} md files ({self.bytes:,} bytes) "
+                f"would be archived into {len(shards)} shards under {archive_dir}"
+            )
+
+
+class MapReduce:
+    # split input too big for one request, answer each chunk, then combine the answers
+    def __init__(
+        self,
+        client: Client,
+        chunk_tokens: int = MAP_CHUNK_TOKENS,
+        concurrency: int = MAP_CONCURRENCY,
+    ):
+        self.client = client
+        self.chunk_tokens = chunk_tokens
+        self.concurrency = concurrency
+        self.cache_dir = os.path.join(client.config.prompts_dir, "mapreduce")
+
+    @staticmethod
+    def New(
+        client: Client,
+        chunk_tokens: int = MAP_CHUNK_TOKENS,
+        concurrency: int = MAP_CONCURRENCY,
+    ):
+        return MapReduce(client, chunk_tokens, concurrency)
+
+    @staticmethod
+    def tokens(text: str) -> int:
+        # ~4 chars per token is close enough for sizing chunks
+        return len(text) // 4 + 1
+
+    def split(self, text: str) -> List[str]:
+        max_chars = self.chunk_tokens * 4
+        pieces: List[str] = []
+        for paragraph in re.split(r"(?<=\n\n)", text):
+            if len(paragraph) <= max_chars:
+                pieces.append(paragraph)
+                continue
+            for line in paragraph.splitlines(keepends=True):
+                pieces.extend(
+                    line[i : i + max_chars] for i in range(0, len(line), max_chars)
+                )
+        chunks: List[str] = []
+        current = ""
+        for piece in pieces:
+            if current and len(current) + len(piece) > max_chars:
+                chunks.append(current)
+                current = ""
+            current += piece
+        if current.strip():
+            chunks.append(current)
+        return chunks
+
+    def cache_path(self, model: str, messages: List[PromptType]):
+        key = json.dumps([model, self.client.config.max_tokens, messages])
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest + ".json")
+
+    def ask(self, messages: List[PromptType], model: str) -> str:
+        filename = self.cache_path(model, messages)
+        if os.path.exists(filename):
+            with open(filename) as f:
+                return json.load(f)["content"]
+        response, error = self.client.fetcher.prompt(
+            messages,
+            model,
+            self.client.config.temp / 10,
+            max_tokens=self.client.config.max_tokens,
+            batch=True,
+        )
+        if error:
+            raise Exception(str(error))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        util.atomic_write(filename, json.dumps({"content": response}))
+        return str(response)
+
+    def messages(self, system: str, content: str) -> List[PromptType]:
+        prompts = [Prompt.user(content)]
+        return [Prompt.system(system)] + prompts if system else prompts
+
+    def map(self, prompt: str, chunks: List[str], system: str, model: str):
+        results: List[str | None] = [None] * len(chunks)
+        failed: List[Tuple[int, Exception]] = []
+        done = 0
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency) as pool:
+            futures = {
+                pool.submit(
+                    self.ask,
+                    self.messages(
+                        system,
+                        f"{prompt}\n\nThe input is split into {len(chunks)} parts, "
+                        f"this is part {i + 1}:\n\n{chunk}",
+                    ),
+                    model,
+                ): i
+                for i, chunk in enumerate(chunks)
+            }
+            for future in concurrent.futures.as_completed(futures):
+                i = futures[future]
+                done += 1
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    failed.append((i, e))
+                print(
+                    f"\rmap {done}/{len(chunks)} failed {len(failed)}",
+                    end="",
+                    file=sys.stderr,
+                )
+        print(file=sys.stderr)
+        return results, sorted(failed, key=lambda f: f[0])
+
+    def reduce(self, prompt: str, answers: List[str], system: str, model: str) -> str:
+        parts = [f"### Part {i + 1}\n\n{a}\n\n" for i, a in enumerate(answers)]
+        groups = self.split("".join(parts))
+        if len(groups) >= len(answers):
+            # no room to combine in rounds, send them all in one request
+            groups = ["".join(parts)]
+        if len(groups) > 1:
+            # the partial answers alone are too big, combine them in rounds
+            results, failed = self.map(
+                "Combine these partial answers, keep every detail that matters for: "
+                + prompt,
+                groups,
+                system,
+                model,
+            )
+            if failed:
+                raise Exception(f"{len(failed)} reduce chunks failed")
+            return self.reduce(prompt, [str(r) for r in results], system, model)
+        print("reduce", file=sys.stderr)
+        return self.ask(
+            self.messages(
+                system,
+                f"{prompt}\n\nThe input was too long and was split into {len(answers)} "
+                "parts. "
+                "These are the answers for each part, combine them into one "
+                "answer:\n\n" + groups[0],
+            ),
+            model,
+        )
+
+    def gc(self, ttl: timedelta = MAP_CACHE_TTL, dry_run: bool = False):
+        if not os.path.isdir(self.cache_dir):
+            return 0
+        cutoff = (datetime.now() - ttl).timestamp()
+        removed = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.stat().st_mtime < cutoff:
+                    if not dry_run:
+                        os.remove(entry.path)
+                    removed += 1
+        return removed
+
+    def run(self, prompt: str, text: str, system: str = "", model: str = ""):
+        model = model or self.client.model
+        chunks = self.split(text)
+        if not chunks:
+            raise Exception("no input given")
+        print(
+            f"{len(chunks)} chunks of <= {self.chunk_tokens} tokens, "
+            f"{self.concurrency} at a time",
+            file=sys.stderr,
+        )
+        with Telemetry.span("map"):
+            results, failed = self.map(prompt, chunks, system, model)
+        if failed:
+            for i, e in failed:
+                print(f"chunk {i + 1} failed: {e}", file=sys.stderr)
+            raise Exception(
+                f"{len(failed)} of {len(chunks)} chunks failed, run again to retry "
+                "only those"
+            )
+        if len(chunks) == 1:
+            return str(results[0])
+        with Telemetry.span("reduce"):
+            return self.reduce(prompt, [str(r) for r in results], system, model)
+
+
+class Spool:
+    # prompts waiting for the network: one json file per request under <prompts>/queue,
+    # with the assembled messages, so a flush sends exactly what would have been sent
+    def __init__(self, client: Client, concurrency: int = MAP_CONCURRENCY):
+        self.client = client
+        self.concurrency = concurrency
+        self.dir = os.path.join(client.config.prompts_dir, "queue")
+
+    @staticmethod
+    def New(client: Client, concurrency: int = MAP_CONCURRENCY):
+        return Spool(client, concurrency)
+
+    def put(
+        self,
+        convo: str,
+        prompt: str,
+        messages: List[Any],
+        model: str,
+        error: str | None = None,
+    ):
+        os.makedirs(self.dir, exist_ok=True)
+        # names sort in queue order
+        filename = os.path.join(self.dir, f"{time.time_ns()}.{util.uuid()}.json")
+        entry = {
+            "convo": convo,
+            "prompt": prompt,
+            "messages": messages,
+            "model": model,
+            "queued": datetime.now().isoformat(),
+            "attempts": 0,
+            "error": error,
+        }
+        util.atomic_write(filename, json.dumps(entry))
+        return filename
+
+    def entries(self):
+        try:
+            names = sorted(n for n in os.listdir(self.dir) if n.endswith(".json"))
+        except FileNotFoundError:
+            return []
+        entries: List[Tuple[str, Dict[str, Any]]] = []
+        for name in names:
+            filename = os.path.join(self.dir, name)
+            with open(filename) as f:
+                entries.append((filename, json.load(f)))
+        return entries
+
+    def send(self, entry: Dict[str, Any]):
+        attempt = 0
+        while True:
+            with Ledger.scope(entry["convo"]):
+                response, error = self.client.fetcher.prompt(
+                    entry["messages"],
+                    entry["model"],
+                    self.client.config.temp / 10,
+                    max_tokens=self.client.config.max_tokens,
+                    batch=True,
+                )
+            if not error:
+                return Prompt.ai(str(response))
+            attempt += 1
+            # waiting does not bring spend under a budget, it stays queued as is
+            if isinstance(error, BudgetError):
+                raise error
+            if attempt >= QUEUE_RETRIES or not util.retryable(error):
+                raise error
+            # 429 or a hiccup, back off before trying again
+            time.sleep(2**attempt + random.random())
+
+    def deliver(self, entry: Dict[str, Any], ai_prompt: PromptType):
+        context = Context.New(
+            convo=entry["convo"], prompts_dir=self.client.config.prompts_dir
+        )
+        client = Client.New(
+            fetcher=self.client.fetcher, config=self.client.config, context=context
+        )
+        user_prompt = Prompt.user(entry["prompt"])
+        client.add_prompts(user_prompt, ai_prompt)
+        return client.context.md_file
+
+    def flush(self):
+        os.makedirs(self.dir, exist_ok=True)
+        # a second flush waits instead of sending the same requests again
+        with FileLock(os.path.join(self.dir, ".lock")):
+            entries = self.entries()
+            if not entries:
+                return print("queue is empty")
+            with concurrent.futures.ThreadPoolExecutor(self.concurrency) as pool:
+                futures = [pool.submit(self.send, entry) for _, entry in entries]
+                # answers go into their convos in queue order, whenever they arrive
+                for i, ((filename, entry), future) in enumerate(zip(entries, futures)):
+                    status = self.settle(filename, entry, future)
+                    print(f"{i + 1}/{len(entries)} {entry['convo']}: {status}")
+
+    def settle(
+        self,
+        filename: str,
+        entry: Dict[str, Any],
+        future: "concurrent.futures.Future[PromptType]",
+    ):
+        try:
+            ai_prompt = future.result()
+        except BudgetError as e:
+            # not a failed attempt, it goes out once the budget allows it
+            entry["error"] = str(e)
+            util.atomic_write(filename, json.dumps(entry))
+            return f"still queued ({e})"
+        except Exception as e:
+            entry["attempts"] += 1
+            entry["error"] = str(e)
+            if util.retryable(e) and entry["attempts"] < QUEUE_MAX_ATTEMPTS:
+                util.atomic_write(filename, json.dumps(entry))
+                return f"still queued ({e})"
+            # out of attempts, it ends up in the convo like any other failed prompt
+            ai_prompt = Prompt.ai("Error:" + str(e))
+        md_file = self.deliver(entry, ai_prompt)
+        os.remove(filename)
+        return md_file or "sent"
+
+
+class TemplateError(Exception):
+    pass
+
+
+class Template:
+    # a template compiled to a str.format string, includes already inlined
+    def __init__(
+        self,
+        name: str,
+        fmt: str,
+        names: List[str],
+        defaults: Dict[str, str],
+        deps: List[Tuple[str, int]],
+    ):
+        self.name = name
+        self.fmt = fmt
+        self.names = names
+        self.defaults = defaults
+        # (path, mtime_ns) of every file it was compiled from
+        self.deps = deps
+
+    def render(self, values: Dict[str, Any]) -> str:
+        try:
+            return self.fmt.format_map({**self.defaults, **values})
+        except KeyError:
+            missing = [
+                n for n in self.names if n not in values and n not in self.defaults
+            ]
+            raise TemplateError(
+                f"template {self.name} needs " + " ".join(f"{n}=..." for n in missing)
+            )
+
+    def fresh(self):
+        try:
+            return all(os.stat(path).st_mtime_ns == mtime for path, mtime in self.deps)
+        except FileNotFoundError:
+            return False
+
+
+class Templates:
+    # named prompts in <prompts>/templates/<name>.md: {{var}}, {{var|default}} and
+    # {{> other}} includes; compiled once and reused until one of their files changes
+    TOKEN = re.compile(r"\{\{\s*(>\s*)?([\w.-]+)\s*(?:\|(.*?))?\}\}", re.S)
+    compiled: Dict[str, Template] = {}
+
+    def __init__(self, prompts_dir: str = PROMPTS_DIR):
+        self.dir = os.path.join(prompts_dir, TEMPLATES_DIRNAME)
+
+    @staticmethod
+    def New(prompts_dir: str = PROMPTS_DIR):
+        return Templates(prompts_dir)
+
+    def path(self, name: str):
+        return os.path.join(self.dir, name + TEMPLATE_EXT)
+
+    def names(self):
+        try:
+            return sorted(
+                n[: -len(TEMPLATE_EXT)]
+                for n in os.listdir(self.dir)
+                if n.endswith(TEMPLATE_EXT)
+            )
+        except FileNotFoundError:
+            return []
+
+    def get(self, name: str) -> Template:
+        path = self.path(name)
+        template = Templates.compiled.get(path)
+        if template is None or not template.fresh():
+            template = self.compile(name)
+            Templates.compiled[path] = template
+        return template
+
+    def compile(self, name: str) -> Template:
+        names: List[str] = []
+        defaults: Dict[str, str] = {}
+        deps: List[Tuple[str, int]] = []
+
+        def inline(name: str, stack: List[str]) -> str:
+            if name in stack:
+                raise TemplateError(
+                    "template include loop: " + " > ".join(stack + [name])
+                )
+            path = self.path(name)
+            try:
+                deps.append((path, os.stat(path).st_mtime_ns))
+                with open(path) as f:
+                    text = f.read()
+            except FileNotFoundError:
+                raise TemplateError(f"no template {name} in {self.dir}")
+            fmt = ""
+            end = 0
+            for match in Templates.TOKEN.finditer(text):
+                # literal braces survive str.format doubled
+                fmt += text[end : match.start()].replace("{", "{{").replace("}", "}}")
+                end = match.end()
+                include, key, default = match.groups()
+                if include:
+                    fmt += inline(key, stack + [name])
+                    continue
+                if not key.isidentifier():
+                    raise TemplateError(f"bad placeholder {match.group(0)} in {path}")
+                if key not in names:
+                    names.append(key)
+                if default is not None:
+                    defaults.setdefault(key, default)
+                fmt += "{" + key + "}"
+            return fmt + text[end:].replace("{", "{{").replace("}", "}}")
+
+        fmt = inline(name, [])
+        return Template(name, fmt, names, defaults, deps)
+
+    @staticmethod
+    def values(words: List[str]) -> Tuple[Dict[str, str], List[str]]:
+        # key=value, key=@file and key=@- (stdin); anything else is {{input}}
+        values: Dict[str, str] = {}
+        rest: List[str] = []
+        for word in words:
+            key, eq, value = word.partition("=")
+            if not eq or not key.isidentifier():
+                rest.append(word)
+                continue
+            if value == "@-":
+                value = util.read_stdin()
+            elif value.startswith("@"):
+                try:
+                    with open(os.path.expanduser(value[1:])) as f:
+                        value = f.read()
+                except OSError as e:
+                    raise TemplateError(f"{key}: {e}")
+            values[key] = value
+        return values, rest
+
+    def render_lines(self, name: str, filename: str) -> List[str]:
+        # one json object of variables per line, errors point at the line
+        template = self.get(name)
+        source = "stdin" if filename == "-" else filename
+        prompts: List[str] = []
+        try:
+            f = open(0 if filename == "-" else filename)
+        except OSError as e:
+            raise TemplateError(f"{source}: {e.strerror}")
+        with f:
+            for n, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    values = json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise TemplateError(f"{source}:{n}: bad json, {e}")
+                if not isinstance(values, dict):
+                    raise TemplateError(f"{source}:{n}: not a json object of variables")
+                try:
+                    prompts.append(template.render(values))
+                except TemplateError as e:
+                    raise TemplateError(f"{source}:{n}: {e}")
+        return prompts
+
+    def render_args(self, name: str, words: List[str]) -> str:
+        template = self.get(name)
+        values, rest = Templates.values(words)
+        if rest:
+            values.setdefault("input", " ".join(rest))
+        if "stdin" in template.names and "stdin" not in values:
+            values["stdin"] = util.read_stdin()
+        return template.render(values)
+
+
 class Interactive:
     def __init__(self, client: Client, fetcher: Fetch):
         self.fetcher = fetcher
@@ -1297,9 +4729,7 @@ class Interactive:
         print("new context/convo created")
 
     def set_editor(self, editor: str):
-        c = Config.New()
-        c.open()
-        c.editor = editor
+        self.client.config.editor = editor
         return print("set editor to", editor)
 
     def set_temp(self, temp: int):
@@ -1312,39 +4742,77 @@ class Interactive:
     def check_fresh_context(self):
         if self.should_date_make_new():
             self.client.new_context()
+        self.client.rollover()
 
-    def fork(self):
-        convo = util.uuid()
-        ctx_file = util.ctx_path(self.client.config.prompts_dir, convo)
-        self.client.context.filename = ctx_file
-        self.client.context.smart_title_slug = "forked_from_" + (
-            self.client.context.smart_title_slug or convo
-        )
-        self.client.context.smart_title = "Forked From " + (
-            self.client.context.smart_title or convo
-        )
-        self.client.context.md_file = self.client.mk_prompt_path(
-            self.client.context.smart_title_slug
-        )
-        self.client.context.save()
-        self.client.write_header()
-        self.client.write_conversation()
+    def fork(self, name: str = ""):
+        ctx = self.client.context
+        name = name or f"fork{len(ctx.obj.get('branches') or {}) + 1}"
+        ctx.add_branch(name)
+        return print(f"forked convo as branch '{name}', still on the current one")
 
     def edit(self):
         msgs = ""
         ctx_msgs = self.client.context.messages
         for i, msg in enumerate(ctx_msgs):
-            m = msg["content"][0:40].replace("\n", "")
+            m = str(msg["content"])[0:40].replace("\n", "")
             r = msg["role"]
             msgs += f"{i} {r} / {m}...\n"
 
         result = self.author_prompt(msgs) or ""
         result_array = result.split("\n")
-        numbers_array = [int(item.split(" ")[0]) for item in result_array if item]
-        ctx_msgs = list(filter(lambda x: ctx_msgs.index(x) in numbers_array, ctx_msgs))
-        self.client.context.messages = ctx_msgs
-        self.client.write_header()
-        self.client.write_conversation()
+        numbers_array = {int(item.split(" ")[0]) for item in result_array if item}
+        # the messages that were dropped stay in the convo as the previous branch
+        self.client.context.messages = [
+            msg for i, msg in enumerate(ctx_msgs) if i in numbers_array
+        ]
+        self.client.write_md()
+
+    def branch_list(self):
+        return self.client.context.branches()
+
+    def branch_titles(self):
+        titles: List[str] = []
+        for _, names, path in self.branch_list():
+            users = [m for m in path if m["role"] == "user"]
+            last = str(users[-1]["content"]) if users else ""
+            label = ",".join(names) or f"{len(path)} messages"
+            titles.append(f"{label}: {last[:60]}".replace("\n", " "))
+        return titles
+
+    def print_branches(self):
+        head = self.client.context.head
+        for i, ((tip, _, __), title) in enumerate(
+            zip(self.branch_list(), self.branch_titles())
+        ):
+            mark = "*" if tip == head else " "
+            print(f"{mark} {i}: {title}")
+
+    def set_branch(self, index_or_name: str):
+        branches = self.branch_list()
+        names = {name: tip for tip, names, _ in branches for name in names}
+        if index_or_name in names:
+            self.client.context.set_head(names[index_or_name])
+            self.client.write_md()
+            return print(f"branch set: {index_or_name}")
+
+        def setter(idx: int):
+            self.client.context.set_head(branches[idx][0])
+            self.client.write_md()
+
+        return self.pick_list(self.branch_titles(), index_or_name, setter, "branch")
+
+    def branch_md(self, index_or_name: str):
+        branches = self.branch_list()
+        names = {name: path for _, names, path in branches for name in names}
+
+        def output(idx: int):
+            util.log(self.client.md_text(branches[idx][2])[0])
+
+        if index_or_name in names:
+            return util.log(self.client.md_text(names[index_or_name])[0])
+        return self.pick_list(
+            self.branch_titles(), index_or_name, output, "branch", log_title=False
+        )
 
     def should_date_make_new(self):
         end_date = self.client.context.end_date or datetime.now()
@@ -1355,14 +4823,21 @@ class Interactive:
             return ans.lower() == "y"
         return False
 
-    def show_contents(self, index_or_name: str):
+    def show_contents(self, index_or_name: str, window: slice | None = None):
         bs = self.client.convos_with_titles()
         convo_titles = [str(title) for _, title, __ in bs]
 
         def output_md_file(idx: int):
-            convo = bs[idx][0]
-            ctx_file = util.ctx_path(self.client.config.prompts_dir, convo)
-            md_file = json.load(open(ctx_file))["md_file"]
+            convo, _, md_file = bs[idx]
+            if window is not None:
+                # seek straight to the requested turns, codify only sees those
+                ctx = Context.New(
+                    convo=convo, prompts_dir=self.client.config.prompts_dir
+                )
+                ctx.open()
+                return util.log_stream(
+                    util.md_window(md_file, ctx.md_turns(md_file), window)
+                )
             with open(md_file, "r") as mdf:
                 util.log(mdf.read())
 
@@ -1379,11 +4854,19 @@ class Interactive:
 
         def output_md_file(idx: int):
             convo = bs[idx][0]
-            ctx_file = util.ctx_path(self.client.config.prompts_dir, convo)
-            ctx_json = json.load(open(ctx_file))
+            ctx = Context.New(convo=convo, prompts_dir=self.client.config.prompts_dir)
+            ctx.open()
+            # only decompress the messages when they are asked for
+            if not keys or "messages" in keys:
+                ctx_json = ctx.to_dict()
+            else:
+                ctx_json = ctx.serialize()
             # print ctx json to stdout
 
-            if keys:
+            if util.json_out:
+                picked = {k: ctx_json[k] for k in keys} if keys else ctx_json
+                util.emit({"type": "context", "convo": convo, **picked})
+            elif keys:
                 for key in keys:
                     print(ctx_json[key])
             else:
@@ -1397,6 +4880,12 @@ class Interactive:
         )
 
     def set_convo(self, index_or_name: str):
+        # an exact convo id needs no listing at all
+        if not index_or_name.isdigit() and os.path.exists(
+            util.ctx_path(self.client.config.prompts_dir, index_or_name)
+        ):
+            self.client.convo = index_or_name
+            return print(f"convo set: {index_or_name}")
         bs = self.client.convos_with_titles()
         convo_titles = [str(title) for _, title, __ in bs]
         return self.pick_list(
@@ -1498,6 +4987,7 @@ class Interactive:
             else:
                 print(f"\033[1m{i}:{model}\033[0m")
 
+    @Telemetry.timed("editor")
     def author_prompt(self, content: str = "", is_retry: bool = False):
         if is_retry:
             content = self.client.pop_user_prompt() or ""
@@ -1507,6 +4997,7 @@ class Interactive:
                 f.write(content)
             editor: str = self.client.editor
             subprocess.run([editor, file], check=True)
+            Telemetry.marks["editor_exit"] = time.perf_counter()
             with open(file, "r") as f:
                 pmpt = f.read().strip()
                 return pmpt if pmpt != "" else None
@@ -1552,9 +5043,109 @@ class Interactive:
         system = self.client.get_system()
         if system:
             prompts = [Prompt.system(system)] + prompts
-        return util.log(
-            self.client.fetch_prompt(prompts, model=model, stream=stream)["content"]
-        )
+        ai_prompt = self.client.fetch_prompt(prompts, model=model, stream=stream)
+        if util.json_out:
+            return self.client.emit_answer(sentence, ai_prompt, model, saved=False)
+        if stream and Sink.current:
+            # already streamed into HEY_OUT
+            return Sink.current.write("\n")
+        return util.log(ai_prompt["content"])
+
+    def pipe_prompt(self, sentence: str | None, max_bytes: int = PIPE_MAX_BYTES):
+        content = "\n\n".join(s for s in [sentence, util.read_stdin(max_bytes)] if s)
+        if not content.strip():
+            print("no prompt given", file=sys.stderr)
+            sys.exit(1)
+        prompts: List[PromptType] = [Prompt.user(content)]
+        system = self.client.get_system()
+        if system:
+            prompts = [Prompt.system(system)] + prompts
+        try:
+            ai_prompt = self.client.fetch_prompt(prompts, pipe=True)
+        except Exception:
+            sys.exit(1)
+        if util.json_out:
+            return self.client.emit_answer(content, ai_prompt, saved=False)
+        if not ai_prompt["content"].endswith("\n"):
+            try:
+                sys.stdout.write("\n")
+                sys.stdout.flush()
+            except BrokenPipeError:
+                util.silence_stdout()
+
+    def map_reduce_prompt(
+        self,
+        sentence: str | None,
+        max_bytes: int = MAP_REDUCE_MAX_BYTES,
+        chunk_tokens: int = MAP_CHUNK_TOKENS,
+        concurrency: int = MAP_CONCURRENCY,
+    ):
+        text = util.read_stdin(max_bytes)
+        if not sentence or not text.strip():
+            return print("usage: <input> | hey --map_reduce <prompt>", file=sys.stderr)
+        mapreduce = MapReduce.New(self.client, chunk_tokens, concurrency)
+        try:
+            answer = mapreduce.run(sentence, text, system=self.client.get_system())
+        except Exception as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        if util.json_out:
+            return self.client.emit_answer(sentence, Prompt.ai(answer), saved=False)
+        return util.log(answer)
+
+    def flush_queue(self, concurrency: int = MAP_CONCURRENCY):
+        return Spool.New(self.client, concurrency).flush()
+
+    def print_templates(self):
+        templates = Templates.New(self.client.config.prompts_dir)
+        names = templates.names()
+        if not names:
+            return print(f"no templates in {templates.dir}")
+        for name in names:
+            try:
+                variables = " ".join(templates.get(name).names)
+            except TemplateError as e:
+                variables = f"({e})"
+            print(f"{name}: {variables}")
+
+    def tpl_batch(
+        self,
+        name: str,
+        filename: str,
+        concurrency: int = MAP_CONCURRENCY,
+        dry_run: bool = False,
+    ):
+        # one json object of variables per line, one answer per line back, in order
+        templates = Templates.New(self.client.config.prompts_dir)
+        prompts = templates.render_lines(name, filename)
+        if dry_run:
+            for i, prompt in enumerate(prompts):
+                util.emit({"type": "prompt", "index": i, "prompt": prompt})
+            return
+        system = self.client.get_system()
+        model = self.client.model
+
+        def send(prompt: str):
+            messages = [Prompt.user(prompt)]
+            if system:
+                messages = [Prompt.system(system)] + messages
+            return self.client.fetcher.prompt(
+                messages,
+                model,
+                self.client.config.temp / 10,
+                max_tokens=self.client.config.max_tokens,
+                batch=True,
+            )
+
+        failed = 0
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+            for i, (answer, error) in enumerate(pool.map(send, prompts)):
+                if error:
+                    failed += 1
+                    util.emit({"type": "error", "index": i, "error": str(error)})
+                else:
+                    util.emit({"type": "answer", "index": i, "answer": answer})
+        print(f"{len(prompts) - failed}/{len(prompts)} answered", file=sys.stderr)
 
     def do_prompt(
         self,
@@ -1565,51 +5156,144 @@ class Interactive:
         stream: bool = False,
         imgs: List[str] = [],
         system: str = "You are a helpful assistant.",
+        queue: bool = False,
     ):
         prompt: str = ""
         system = self.client.get_system() or system
+        warm = None
+        sink = None
+        model = ""
         try:
-            prompt = (
-                (self.author_prompt(content, is_retry) or "")
-                if open_editor
-                else content
-            )
+            if open_editor:
+                if is_retry:
+                    content = self.client.pop_user_prompt() or ""
+                warm = self.client.prewarm(system, imgs)
+                prompt = self.author_prompt(content) or ""
+            else:
+                prompt = content
             if not prompt:
                 return print("no prompt given")
             print(prompt)
             model = "gpt-4-vision-preview" if imgs else ""
-            ai_prompt = self.client.fetch_prompt_with_context(
-                system=system,
-                prompt=prompt,
-                trim=trim,
-                stream=stream,
-                model=model,
-                imgs=imgs,
-            )
-            user_prompt = Prompt.user(prompt)
-            self.client.add_prompts(user_prompt, ai_prompt)
-            util.log_prompts(user_prompt, ai_prompt)
+            if queue:
+                self.client.queue_prompt(
+                    prompt,
+                    system,
+                    trim,
+                    model,
+                    imgs,
+                    warm,
+                    error="deferred with --queue",
+                )
+                return self.queued(prompt)
+            sink = Sink.current if stream and not util.json_out else None
+            if sink:
+                # the answer streams into HEY_OUT right after this as it arrives
+                sink.write(
+                    util.msg_block(Prompt.user(prompt)) + util.msg_head("assistant")
+                )
+            try:
+                ai_prompt = self.client.fetch_prompt_with_context(
+                    system=system,
+                    prompt=prompt,
+                    trim=trim,
+                    stream=stream,
+                    model=model,
+                    imgs=imgs,
+                    warm=warm,
+                )
+            except Exception as e:
+                if not util.retryable(e):
+                    raise
+                # no answer yet, queue the prompt instead of an error in the convo
+                self.client.queue_prompt(
+                    prompt, system, trim, model, imgs, warm, error=str(e)
+                )
+                return self.queued(prompt, e)
         except Exception as e:
             self.client.add_prompt(Prompt().user(prompt))
             self.client.add_prompt(Prompt().ai("Error:" + str(e)))
             self.client.write_all()
-            print(e)
+            if util.json_out:
+                util.emit(
+                    {"type": "error", "convo": self.client.convo, "error": str(e)}
+                )
+            return print(e)
+        # the answer is in; saving or printing it must not queue it a second time
+        user_prompt = Prompt.user(prompt)
+        self.client.add_prompts(user_prompt, ai_prompt)
+        if util.json_out:
+            self.client.emit_answer(prompt, ai_prompt, model)
+        elif sink:
+            sink.write(util.msg_tail("") + "\n")
+        else:
+            util.log_prompts(user_prompt, ai_prompt)
+
+    def queued(self, prompt: str, error: Exception | None = None):
+        if util.json_out:
+            util.emit(
+                {
+                    "type": "queued",
+                    "convo": self.client.convo,
+                    "prompt": prompt,
+                    "error": str(error) if error else None,
+                }
+            )
+        if error:
+            print(error)
+        print("queued, send it with --flush_queue")
 
 
 def main(skip_new: bool = False) -> None:
-    global PROMPTS_DIR
+    if not skip_new:
+        Telemetry.record("import", STARTED, time.perf_counter())
     myclient = Client.New()
     myinteractive: Interactive = Interactive.New(client=myclient)
     myCLI = CLI()
+    Telemetry.enabled = myclient.config.obj.get("metrics", True) and not myCLI.stats
+    Telemetry.command = (
+        " ".join(a for a in sys.argv[1:] if a.startswith("--")) or "prompt"
+    )
+    if myCLI.stats:
+        return Telemetry.stats()
+    if myCLI.json and not util.json_out:
+        # json lines keep the real stdout, print() for humans goes to stderr until
+        # the command is done
+        util.json_out = sys.stdout
+        try:
+            with contextlib.redirect_stdout(sys.stderr):
+                return run(myclient, myinteractive, myCLI, skip_new)
+        finally:
+            util.json_out = None
+    return run(myclient, myinteractive, myCLI, skip_new)
+
+
+def run(
+    myclient: Client, myinteractive: Interactive, myCLI: CLI, skip_new: bool
+) -> None:
+    global PROMPTS_DIR
     trim = myCLI.trim or 0
     util.codify = myclient.get_codify()
+    Fetch.transport = myclient.config.transport
+    Fetch.deadline = myclient.config.deadline
+    Fetch.limiter = RateLimit.New(myclient.config.prompts_dir)
+    Ledger.current = Ledger.New(
+        myclient.config.prompts_dir,
+        myclient.config.budget,
+        myclient.config.budget_mode,
+    )
     stream = bool(myCLI.stream)
 
     imgs: List[str] = []
 
-    if myCLI.fork:
-        myinteractive.fork()
-        return print("forked convo")
+    if myCLI.fork is not None:
+        return myinteractive.fork(myCLI.fork)
+    if myCLI.branches:
+        return myinteractive.print_branches()
+    if myCLI.branch is not None:
+        return myinteractive.set_branch(myCLI.branch)
+    if myCLI.branch_md is not None:
+        return myinteractive.branch_md(myCLI.branch_md)
 
     if myCLI.edit:
         return myinteractive.edit()
@@ -1637,9 +5321,9 @@ def main(skip_new: bool = False) -> None:
         if myCLI.system:
             myclient.set_system(" ".join(myCLI.system))
         else:
-            sys = myinteractive.author_prompt(myclient.get_system())
-            if sys:
-                myclient.set_system(sys)
+            sys_prompt = myinteractive.author_prompt(myclient.get_system())
+            if sys_prompt:
+                myclient.set_system(sys_prompt)
         print("system set to: " + myclient.get_system())
         if myCLI.sentence == None:
             return
@@ -1647,6 +5331,56 @@ def main(skip_new: bool = False) -> None:
     if myCLI.max_tokens:
         myclient.config.max_tokens = myCLI.max_tokens
         return print("max_tokens set to:", myclient.config.max_tokens)
+    if myCLI.transport:
+        if myCLI.transport == "requests" and not HAS_REQUESTS:
+            return print("requests is not installed, use stdlib or asyncio")
+        myclient.config.transport = myCLI.transport
+        return print("transport set to:", myclient.config.transport)
+    if myCLI.deadline:
+        myclient.config.deadline = myCLI.deadline
+        return print("deadline set to:", myclient.config.deadline)
+    if myCLI.budget or myCLI.budget_mode:
+        budget = {**myclient.config.budget, **dict(myCLI.budget or [])}
+        myclient.config.budget = {k: v for k, v in budget.items() if v > 0}
+        if myCLI.budget_mode:
+            myclient.config.budget_mode = myCLI.budget_mode
+        return print(
+            "budget set to:",
+            myclient.config.budget or "none",
+            myclient.config.budget_mode,
+        )
+    if myCLI.cost is not None:
+        return Ledger.current.report(myCLI.cost)
+    if myCLI.rollover or myCLI.rollover_carry:
+        rollover = {**myclient.config.rollover, **dict(myCLI.rollover or [])}
+        myclient.config.rollover = {k: v for k, v in rollover.items() if v > 0}
+        if myCLI.rollover_carry:
+            myclient.config.rollover_carry = myCLI.rollover_carry
+        return print(
+            "rollover set to:",
+            myclient.config.rollover or "off",
+            myclient.config.rollover_carry,
+        )
+    if myCLI.chain:
+        return myclient.print_chain()
+    if myCLI.templates:
+        return myinteractive.print_templates()
+    if myCLI.tpl:
+        try:
+            if myCLI.tpl_batch:
+                return myinteractive.tpl_batch(
+                    myCLI.tpl,
+                    myCLI.tpl_batch,
+                    concurrency=myCLI.concurrency,
+                    dry_run=myCLI.dry_run,
+                )
+            # the rendered template stands in for the sentence
+            myCLI.sentence = Templates.New(myclient.config.prompts_dir).render_args(
+                myCLI.tpl, myCLI.words
+            )
+        except TemplateError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
     if myCLI.codify_on:
         myclient.set_codify(True)
         return print("codify on")
@@ -1670,10 +5404,10 @@ def main(skip_new: bool = False) -> None:
         return myinteractive.set_temp(myCLI.temp)
 
     if myCLI.tidy:
-        return myclient.tidy_contexts()
+        return myclient.tidy_contexts(dry_run=myCLI.dry_run)
 
     if myCLI.show is not None:
-        return myinteractive.show_contents(myCLI.show)
+        return myinteractive.show_contents(myCLI.show, window=myCLI.window)
 
     if myCLI.show_ctx is not None:
         convo, *rest = myCLI.show_ctx
@@ -1695,6 +5429,18 @@ def main(skip_new: bool = False) -> None:
     if myCLI.dir:
         return Client.set_dir(myCLI.dir)
 
+    if myCLI.map_reduce:
+        return myinteractive.map_reduce_prompt(
+            myCLI.sentence,
+            max_bytes=myCLI.pipe_max or MAP_REDUCE_MAX_BYTES,
+            chunk_tokens=myCLI.chunk_tokens,
+            concurrency=myCLI.concurrency,
+        )
+    if myCLI.pipe:
+        return myinteractive.pipe_prompt(
+            myCLI.sentence, max_bytes=myCLI.pipe_max or PIPE_MAX_BYTES
+        )
+
     if myCLI.one_shot:
         return myinteractive.one_shot_prompt(
             content=myCLI.sentence or "",
@@ -1703,10 +5449,12 @@ def main(skip_new: bool = False) -> None:
             imgs=imgs,
         )
 
+    if myCLI.flush_queue:
+        return myinteractive.flush_queue(myCLI.concurrency)
     if myCLI.delete_convo:
         return myinteractive.delete_convo(myCLI.delete_convo)
     if myCLI.archive:
-        return myclient.archive()
+        return myclient.archive(dry_run=myCLI.dry_run)
     if myCLI.qk:
         return myinteractive.qk_prompt(myCLI.sentence, stream=stream, imgs=imgs)
     if myCLI.qk4:
@@ -1718,6 +5466,8 @@ def main(skip_new: bool = False) -> None:
     if myCLI.get_model:
         return print(myclient.model)
     if myCLI.recent:
+        if myCLI.window is not None:
+            return util.log_stream(myclient.most_recent_window(myCLI.window))
         return util.log(myclient.most_recent_convo())
     if myCLI.sentence:
         myinteractive.check_fresh_context()
@@ -1728,6 +5478,7 @@ def main(skip_new: bool = False) -> None:
             open_editor=myCLI.openeditor,
             stream=stream,
             imgs=imgs,
+            queue=myCLI.queue,
         )
     if myCLI.retry:
         return myinteractive.do_prompt(
@@ -1743,7 +5494,12 @@ def main(skip_new: bool = False) -> None:
 
     myinteractive.check_fresh_context()
     return myinteractive.do_prompt(
-        system=myclient.get_system(), content="", trim=trim, stream=stream, imgs=imgs
+        system=myclient.get_system(),
+        content="",
+        trim=trim,
+        stream=stream,
+        imgs=imgs,
+        queue=myCLI.queue,
     )
 
 